@@ -0,0 +1,640 @@
+import math
+import threading
+import time
+import weakref
+
+import numpy as np
+from PIL import Image
+
+from CropResampler import DEFAULT_INTERPOLATION, cropShape, resampleCrop
+from ImageBridge import arrayToQImage
+from Orientation import Orientation
+from ImageStorage import ImageStorage
+from TileScheduler import TileScheduler
+
+
+ADJUSTMENTS = ("brightness", "contrast", "highlight", "shadows", "saturation", "warmth", "sharpness", "radius")
+TONE_ADJUSTMENTS = ("contrast", "highlight", "shadows")
+COLOR_ADJUSTMENTS = ("brightness", "saturation", "warmth")
+PROXY_STEP = 256
+PRECISIONS = ("uint8", "int16", "float16", "float32")
+TABLE_BITS = 4
+SATURATION_BITS = 7
+DETAIL_BITS = 4
+DETAIL_RANGE = 255 << DETAIL_BITS
+SHARPEN_BITS = 4
+DEFAULT_RADIUS = 2
+PRECISION_TOLERANCE = 0.5
+# The engines differ by a fraction of a level, saved files are rendered in float32 unless a batch recipe names an
+# engine, so the same edit gives the same pixels on every machine and run whichever engine the preview picked
+EXPORT_PRECISION = "float32"
+
+benchmarkedPrecision = None
+
+
+def defaultSettings():
+    settings = dict.fromkeys(ADJUSTMENTS, 0)
+    settings["radius"] = DEFAULT_RADIUS
+    return settings
+
+
+def contrastFactor(value):
+    return (259 * (value + 255)) / (255 * (259 - value))
+
+
+def toneLut(settings):
+    # The tonal adjustments are point operations, so the whole chain is evaluated once over the 256 possible
+    # input levels and only clamped at the end, exactly like the per-pixel chain would be
+    levels = np.arange(256, dtype=np.float32)
+
+    if settings["contrast"]:
+        levels = contrastFactor(settings["contrast"]) * (levels - 128) + 128
+
+    if settings["highlight"]:
+        factor = contrastFactor(settings["highlight"])
+        levels = np.where(levels > 140, factor * (levels - 140) + 140, levels)
+
+    if settings["shadows"]:
+        levels = np.where(levels < 140, levels + settings["shadows"] / 3, levels)
+
+    np.clip(levels, 0, 255, out=levels)
+    return np.tile(levels.astype(np.uint8), (3, 1))
+
+
+def applyLut(data, lut, out):
+    # lut holds one 256 entry table per channel, a table shared by all channels is applied in a single pass
+    if (lut == lut[0]).all():
+        np.take(lut[0], data, out=out)
+    else:
+        for channel in range(3):
+            np.take(lut[channel], data[:, :, channel], out=out[:, :, channel])
+    return out
+
+
+def colorMatrix(settings):
+    # Brightness, saturation and warmth are all affine in RGB, so they fold into a single 3x4 matrix
+    matrix = np.zeros((3, 4), np.float32)
+    factor = contrastFactor(settings["saturation"])
+    matrix[:, :3] = (1 - factor) / 3
+    matrix[:, :3] += np.eye(3, dtype=np.float32) * factor
+    matrix[:, 3] = settings["brightness"]
+    matrix[0, 3] += settings["warmth"]
+    matrix[1, 3] += settings["warmth"] * 0.65
+    return matrix
+
+
+def quantize(values, out):
+    # Clamps in place and truncates into the uint8 output, without any temporaries
+    np.clip(values, 0, 255, out=values)
+    np.copyto(out, values, casting="unsafe")
+    return out
+
+
+def colorStage(matrix, precision):
+    # Prepares the colour matrix in the form the engine for this precision consumes
+    if precision == "uint8":
+        levels = np.arange(256, dtype=np.float32)
+        tables = np.rint(matrix[:, :3, None] * levels * (1 << TABLE_BITS)).astype(np.int16)
+        offsets = np.rint(matrix[:, 3] * (1 << TABLE_BITS)).astype(np.int16)
+        return tables, offsets
+    if precision == "int16":
+        # As many fractional bits, up to SATURATION_BITS, as int16 has room for with this saturation and these
+        # offsets. The largest output before clamping is a channel at 255 with the other two at 0
+        factor = float(matrix[0, 0] - matrix[0, 1])
+        peak = max(255, 85 + 170 * factor, 170 * factor - 170) + float(np.abs(matrix[:, 3]).max())
+        bits = SATURATION_BITS
+        while bits and max(255 * factor, 765 * abs(1 - factor), peak) * (1 << bits) > 32000:
+            bits -= 1
+        return bits, int(round(factor * (1 << bits))), np.rint(matrix[:, 3] * (1 << bits)).astype(np.int16)
+    return matrix[:, :3].T.astype(precision), matrix[:, 3].astype(precision)
+
+
+def applyColorMatrix(data, color, out, precision, scratch):
+    if precision == "uint8":
+        # Lookup tables only, each output channel sums the fixed point contribution of every input channel
+        tables, offsets = color
+        values = scratch("colorValues", data.shape, np.int16)
+        part = scratch("colorPart", data.shape[:2], np.int16)
+        for outputChannel in range(3):
+            np.take(tables[outputChannel, 0], data[:, :, 0], out=part)
+            np.copyto(values[:, :, outputChannel], part)
+            for inputChannel in (1, 2):
+                np.take(tables[outputChannel, inputChannel], data[:, :, inputChannel], out=part)
+                values[:, :, outputChannel] += part
+        values += offsets
+        values >>= TABLE_BITS
+        return quantize(values, out)
+
+    if precision == "int16":
+        # Fixed point, saturation scales each channel's distance from the pixel mean: value * factor +
+        # mean * (1 - factor) + offset. Every term keeps its fractional bits and the sum is floored once, the same
+        # truncation quantize applies to the float engines
+        bits, factor, offsets = color
+        values = scratch("colorValues", data.shape, np.int16)
+        mean = scratch("colorMean", data.shape[:2] + (1,), np.int16)
+        np.copyto(values, data)
+        np.sum(values, axis=2, dtype=np.int16, keepdims=True, out=mean)
+        mean *= (1 << bits) - factor
+        mean //= 3
+        values *= factor
+        values += mean
+        values += offsets
+        values >>= bits
+        return quantize(values, out)
+
+    matrix, offsets = color
+    tile = scratch("colorTile", data.shape, precision)
+    values = scratch("colorValues", data.shape, precision)
+    np.copyto(tile, data)
+    np.matmul(tile, matrix, out=values)
+    values += offsets
+    return quantize(values, out)
+
+
+def gaussianKernel(sigma):
+    sigma = max(sigma, 0.5)
+    half = math.ceil(3 * sigma)
+    taps = np.exp(-np.arange(-half, half + 1, dtype=np.float32) ** 2 / (2 * sigma ** 2))
+    return taps / taps.sum()
+
+
+def blurDetail(source, top, bottom, kernel, out, scratch):
+    # Writes source - blur(source) for rows top:bottom in DETAIL_BITS fixed point. The Gaussian is applied as a
+    # vertical then a horizontal pass, edges are extended by repeating the border pixels
+    half = len(kernel) // 2
+    height, width = source.shape[:2]
+    rows = bottom - top
+    first = max(0, top - half)
+    last = min(height, bottom + half)
+    offset = first - (top - half)
+
+    padded = scratch("blurPadded", (rows + 2 * half, width, 3), np.float32)
+    np.copyto(padded[offset:offset + last - first], source[first:last])
+    padded[:offset] = padded[offset]
+    padded[offset + last - first:] = padded[offset + last - first - 1]
+
+    temporary = scratch("blurTemporary", (rows, width, 3), np.float32)
+    vertical = scratch("blurVertical", (rows, width + 2 * half, 3), np.float32)
+    center = vertical[:, half:half + width]
+    np.multiply(padded[:rows], kernel[0], out=center)
+    for tap in range(1, len(kernel)):
+        np.multiply(padded[tap:tap + rows], kernel[tap], out=temporary)
+        center += temporary
+    vertical[:, :half] = center[:, :1]
+    vertical[:, half + width:] = center[:, -1:]
+
+    blurred = scratch("blurred", (rows, width, 3), np.float32)
+    np.multiply(vertical[:, :width], kernel[0], out=blurred)
+    for tap in range(1, len(kernel)):
+        np.multiply(vertical[:, tap:tap + width], kernel[tap], out=temporary)
+        blurred += temporary
+
+    np.subtract(padded[half:half + rows], blurred, out=blurred)
+    blurred *= 1 << DETAIL_BITS
+    np.rint(blurred, out=blurred)
+    np.copyto(out, blurred, casting="unsafe")
+    return out
+
+
+def sharpenStage(amount, precision):
+    if precision == "uint8":
+        # Indexed by the fixed point detail shifted by DETAIL_RANGE
+        details = np.arange(-DETAIL_RANGE, DETAIL_RANGE + 1, dtype=np.float32) / (1 << DETAIL_BITS)
+        return np.trunc(details * amount).astype(np.int16)
+    if precision == "int16":
+        return int(round(amount * (1 << SHARPEN_BITS)))
+    return np.dtype(precision).type(amount / (1 << DETAIL_BITS))
+
+
+def sharpen(data, detail, sharpening, out, precision, scratch):
+    # Unsharp mask, the cached detail layer is scaled by the amount and added back in one pass
+    if precision == "uint8":
+        index = scratch("sharpenIndex", detail.shape, np.int16)
+        values = scratch("sharpenValues", detail.shape, np.int16)
+        np.add(detail, DETAIL_RANGE, out=index)
+        np.take(sharpening, index, out=values)
+    elif precision == "int16":
+        # The detail is rounded to two fractional bits so the product stays inside int16
+        values = scratch("sharpenValues", detail.shape, np.int16)
+        np.add(detail, 1 << (DETAIL_BITS - 3), out=values)
+        values >>= DETAIL_BITS - 2
+        values *= sharpening
+        values >>= SHARPEN_BITS + 2
+    else:
+        values = scratch("sharpenValues", detail.shape, precision)
+        np.multiply(detail, sharpening, out=values)
+    values += data
+    return quantize(values, out)
+
+
+def defaultPrecision():
+    # Times every engine on a small synthetic tile once per process and keeps the fastest one whose result is on
+    # average within PRECISION_TOLERANCE levels of float32
+    global benchmarkedPrecision
+    if benchmarkedPrecision is not None:
+        return benchmarkedPrecision
+
+    data = np.random.default_rng(0).integers(0, 256, (64, 1024, 3), dtype=np.uint8)
+    settings = defaultSettings()
+    settings.update(brightness=10, saturation=30, warmth=20)
+    matrix = colorMatrix(settings)
+    scratch = TileScheduler(1).scratch
+    detail = np.random.default_rng(1).integers(-400, 400, data.shape, dtype=np.int16)
+    colored = np.empty_like(data)
+    output = np.empty_like(data)
+    reference = None
+    timings = {}
+
+    for precision in reversed(PRECISIONS):
+        color = colorStage(matrix, precision)
+        sharpening = sharpenStage(1.5, precision)
+        durations = []
+        for _ in range(3):
+            start = time.perf_counter()
+            applyColorMatrix(data, color, colored, precision, scratch)
+            sharpen(colored, detail, sharpening, output, precision, scratch)
+            durations.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = output.astype(np.int16)
+        if np.abs(output - reference).mean() <= PRECISION_TOLERANCE:
+            timings[precision] = min(durations)
+
+    benchmarkedPrecision = min(timings, key=timings.get)
+    print("adjustment engine precision: {} ({})".format(benchmarkedPrecision, ", ".join(
+        "{} {:.2f} ms".format(precision, timing * 1000) for precision, timing in timings.items())))
+    return benchmarkedPrecision
+
+
+class AdjustmentPipeline:
+    def __init__(self, source, storage=None, precision=None, interpolation=DEFAULT_INTERPOLATION, tileScheduler=None):
+        self.tileScheduler = tileScheduler or TileScheduler()
+        self.storage = storage or ImageStorage()
+        self.precision = precision or defaultPrecision()
+        self.interpolation = interpolation
+        self.bufferLock = threading.Lock()
+        # Every render key rasterises its crop and blurs its detail layer under its own locks, the proxy rendered on
+        # the GUI thread never waits for the worker working on the full resolution
+        self.cropLocks = {key: threading.Lock() for key in ("proxy", "crop")}
+        self.detailLocks = {key: threading.Lock() for key in ("full", "proxy", "crop")}
+        # The generation only ever grows, a render started before any invalidation or source change is never cached
+        self.generation = 0
+        self.loadSource(source)
+
+    def loadSource(self, source):
+        self.source = source
+        self.renders = {}
+        self.details = {}
+        self.regions = {}
+        self.crops = {}
+        self.crop = None
+        self.orientation = Orientation()
+        self.outputBuffers = {}
+        # The decoded pixels belong to the source and are never written, rotations and flips are applied when a
+        # crop is rasterised
+        self.originalData = source.array()
+        self.sourceData = self.originalData
+        self.proxyData = None
+        self.settings = defaultSettings()
+        self.invalidate()
+
+    def downsample(self, data, factor):
+        rows = factor * max(1, self.tileScheduler.tileRows(data.shape[1]) // factor)
+        strips = [np.asarray(Image.fromarray(np.ascontiguousarray(data[top:top + rows]), "RGB").reduce(factor))
+                  for top in range(0, data.shape[0], rows)]
+        return np.concatenate(strips)
+
+    def invalidate(self):
+        # Renders started before an invalidation belong to an older generation and are not cached
+        self.generation += 1
+        self.renders = {}
+        self.images = {}
+
+    def upgradeSource(self, source):
+        # The full decode replacing the draft keeps the adjustments and orientation, the crop is set again by the
+        # caller in the coordinates of the new source
+        settings, orientation = self.settings, self.orientation
+        self.loadSource(source)
+        self.settings, self.orientation = settings, orientation
+
+    def snapshot(self, precision=None):
+        # A pipeline frozen at the current edit for work that runs while editing goes on, it shares the source and
+        # the workers but none of the caches
+        pipeline = AdjustmentPipeline(self.source, self.storage, precision or self.precision, self.interpolation,
+                                      self.tileScheduler)
+        pipeline.settings = dict(self.settings)
+        pipeline.orientation = self.orientation
+        pipeline.crop = self.crop
+        return pipeline
+
+    def resetSource(self):
+        self.sourceData = self.originalData
+        self.proxyData = None
+        self.details = {}
+        self.crop = None
+        self.orientation = Orientation()
+        self.invalidate()
+
+    def setPrecision(self, precision):
+        # None goes back to the benchmarked engine
+        self.precision = precision or defaultPrecision()
+        self.invalidate()
+
+    def setInterpolation(self, interpolation):
+        self.interpolation = interpolation
+        self.crops = {}
+        self.invalidate()
+
+    def resetSettings(self):
+        self.settings = defaultSettings()
+        self.invalidate()
+
+    def setProxySize(self, size):
+        sourceSize = max(self.sourceData.shape[:2])
+        size = min(sourceSize, math.ceil(max(1, size) / PROXY_STEP) * PROXY_STEP)
+        if self.proxyData is not None and max(self.proxyData.shape[:2]) >= size:
+            return
+
+        factor = sourceSize // size
+        if factor <= 1:
+            self.proxyData = self.sourceData
+        else:
+            self.proxyData = self.downsample(self.sourceData, factor)
+        self.renders.pop("proxy", None)
+        self.details.pop("proxy", None)
+
+    def orientedSize(self):
+        return self.orientation.size(self.sourceData.shape[1], self.sourceData.shape[0])
+
+    def setCrop(self, crop):
+        # crop is (centerX, centerY, width, height, rotation) in the coordinates of the oriented source, a crop
+        # covering the whole source is stored as None so the cropped renders share the full render
+        centerX, centerY, width, height, rotation = crop
+        sourceWidth, sourceHeight = self.orientedSize()
+        if not rotation and round(width) == sourceWidth and round(height) == sourceHeight:
+            crop = None
+        if crop == self.crop:
+            return
+        self.crop = crop
+        self.generation += 1
+        for key in ("proxy", "crop"):
+            self.renders.pop(key, None)
+
+    def setOrientation(self, orientation):
+        # The full render stays in the orientation of the decode, only the cropped renders depend on it
+        if orientation == self.orientation:
+            return
+        self.orientation = orientation
+        self.generation += 1
+        for key in ("proxy", "crop"):
+            self.renders.pop(key, None)
+
+    def isCropped(self):
+        return self.crop is not None or not self.orientation.isIdentity()
+
+    def cropFrame(self):
+        if self.crop is not None:
+            return self.crop
+        width, height = self.orientedSize()
+        return width / 2, height / 2, width, height, 0
+
+    def proxyScale(self):
+        if self.proxyData is None:
+            return 0
+        return self.proxyData.shape[1] / self.sourceData.shape[1]
+
+    def rotate(self, turns):
+        self.setOrientation(self.orientation.rotate(turns))
+
+    def flip(self, axis):
+        self.setOrientation(self.orientation.flip(axis))
+
+    def renderKey(self, proxy, cropped=False):
+        # The proxy is only shown in the adjust view, so it is always rendered from the crop
+        if proxy and self.proxyData is not None and self.proxyData is not self.sourceData:
+            return "proxy"
+        if (proxy or cropped) and self.isCropped():
+            return "crop"
+        return "full"
+
+    def renderData(self, key, build=True):
+        # Cropped renders work on the crop of their source only, it is rasterised once per source and crop
+        data = self.proxyData if key == "proxy" else self.sourceData
+        if key == "full" or not self.isCropped():
+            return data
+        with self.cropLocks[key]:
+            frame = (self.cropFrame(), self.orientation)
+            cached = self.crops.get(key)
+            if cached is not None and cached[0] == frame and cached[1] is data:
+                return cached[2]
+            if not build:
+                return None
+
+            crop, orientation = frame
+            cropped = self.storage.allocate(cropShape(crop, self.sourceData.shape, data.shape, orientation))
+            resampleCrop(data, crop, self.sourceData.shape, cropped, self.interpolation, self.tileScheduler,
+                         orientation)
+            self.crops[key] = (frame, data, cropped)
+            return cropped
+
+    def isRendered(self, proxy=False, settings=None, cropped=False):
+        key = self.renderKey(proxy, cropped)
+        return key in self.renders and self.renders[key][0] == (settings or self.settings)
+
+    def render(self, proxy=False, settings=None, cropped=False):
+        key = self.renderKey(proxy, cropped)
+        settings = dict(settings or self.settings)
+        rendered = self.renders.get(key)
+        if rendered is not None and rendered[0] == settings:
+            self.lendBuffer(rendered[1])
+            return rendered[1]
+
+        generation = self.generation
+        data = self.renderData(key)
+
+        precision = self.precision
+        lut, color, sharpening = self.stages(settings, precision)
+        detail = None
+        if sharpening is not None:
+            detail = self.detail(key, data, settings["radius"])
+
+        if lut is not None or color is not None or sharpening is not None:
+            output = self.outputBuffer(key, data.shape)
+            self.tileScheduler.run(data.shape[0], data.shape[1], lambda top, bottom: self.renderTile(
+                data, output, top, bottom, lut, color, sharpening, detail, precision))
+            data = output
+
+        if generation == self.generation:
+            self.renders[key] = (settings, data)
+        return data
+
+    def renderRegion(self, region, factor=1, proxy=False, settings=None, cropped=False):
+        # Renders only the (top, left, bottom, right) part of a render, box reduced by factor, so a zoomed in view
+        # can show what is on screen at about display resolution before the whole render is done. top and left
+        # are expected on multiples of factor. The result is not cached, the full render follows in the background
+        key = self.renderKey(proxy, cropped)
+        settings = dict(settings or self.settings)
+        data = self.renderData(key)
+        top, left = max(0, region[0]), max(0, region[1])
+        bottom, right = min(data.shape[0], region[2]), min(data.shape[1], region[3])
+        rendered = self.renders.get(key)
+        if rendered is not None and rendered[0] == settings:
+            return self.reduceRegion(rendered[1][top:bottom, left:right], factor)
+
+        precision = self.precision
+        lut, color, sharpening = self.stages(settings, precision)
+        source = self.regionSource(key, data, (top, left, bottom, right), factor)
+        if lut is None and color is None and sharpening is None:
+            return source
+
+        detail = None
+        if sharpening is not None:
+            detail = self.regionDetail(key, data, settings["radius"], (top, left, bottom, right), factor)
+        # Region frames come from their own buffer list, a dragged slider alternates between two of them like the full
+        # renders do
+        output = self.outputBuffer(("region", key), source.shape)
+        self.tileScheduler.run(source.shape[0], source.shape[1], lambda top, bottom: self.renderTile(
+            source, output, top, bottom, lut, color, sharpening, detail, precision))
+        return output
+
+    def stages(self, settings, precision):
+        lut = toneLut(settings) if any(settings[name] for name in TONE_ADJUSTMENTS) else None
+        color = None
+        if any(settings[name] for name in COLOR_ADJUSTMENTS):
+            color = colorStage(colorMatrix(settings), precision)
+        sharpening = None
+        if settings["sharpness"]:
+            sharpening = sharpenStage(settings["sharpness"] / 50, precision)
+        return lut, color, sharpening
+
+    def renderTile(self, source, output, top, bottom, lut, color, sharpening, detail, precision):
+        tile = source[top:bottom]
+        target = output[top:bottom]
+
+        if lut is not None:
+            tile = applyLut(tile, lut, target)
+
+        if color is not None:
+            tile = applyColorMatrix(tile, color, target, precision, self.tileScheduler.scratch)
+
+        if sharpening is not None:
+            sharpen(tile, detail[top:bottom], sharpening, target, precision, self.tileScheduler.scratch)
+
+    def detail(self, key, data, radius):
+        # The detail layer only depends on the source pixels and the radius, so it is built once per source and
+        # reused for every amount. The radius is scaled down with the proxy so the preview matches the export
+        with self.detailLocks[key]:
+            cached = self.details.get(key)
+            if cached is not None and cached[0] == radius and cached[1] is data:
+                return cached[2]
+
+            scale = self.proxyScale() if key == "proxy" else 1
+            kernel = gaussianKernel(radius * scale)
+            detail = self.storage.allocate(data.shape, np.int16)
+            self.tileScheduler.run(data.shape[0], data.shape[1], lambda top, bottom: blurDetail(
+                data, top, bottom, kernel, detail[top:bottom], self.tileScheduler.scratch))
+            if data is self.renderData(key, build=False):
+                self.details[key] = (radius, data, detail)
+            return detail
+
+    def regionSource(self, key, data, region, factor):
+        # The last region of every render is kept with its detail layers, a dragged slider keeps asking for it
+        cached = self.regions.get(key)
+        if cached is not None and cached[0] == (region, factor) and cached[1] is data:
+            return cached[2]
+        source = self.reduceRegion(data[region[0]:region[2], region[1]:region[3]], factor)
+        self.regions[key] = ((region, factor), data, source, {})
+        return source
+
+    def regionDetail(self, key, data, radius, region, factor):
+        # Cut from the cached detail layer when there is one at this resolution, otherwise only the region is
+        # blurred. It gets a halo of the kernel radius so its edges see the same neighbours as the full layer
+        top, left, bottom, right = region
+        if factor == 1:
+            with self.detailLocks[key]:
+                cached = self.details.get(key)
+                if cached is not None and cached[0] == radius and cached[1] is data:
+                    return cached[2][top:bottom, left:right]
+        cached = self.regions.get(key)
+        if cached is not None and cached[0] == (region, factor) and cached[1] is data and radius in cached[3]:
+            return cached[3][radius]
+
+        scale = (self.proxyScale() if key == "proxy" else 1) / factor
+        kernel = gaussianKernel(radius * scale)
+        halo = len(kernel) // 2 * factor
+        first, firstColumn = max(0, top - halo), max(0, left - halo)
+        block = self.reduceRegion(data[first:bottom + halo, firstColumn:right + halo], factor)
+        detail = self.storage.allocate(block.shape, np.int16)
+        self.tileScheduler.run(block.shape[0], block.shape[1], lambda tileTop, tileBottom: blurDetail(
+            block, tileTop, tileBottom, kernel, detail[tileTop:tileBottom], self.tileScheduler.scratch))
+        rows, columns = -(-(bottom - top) // factor), -(-(right - left) // factor)
+        detail = detail[(top - first) // factor:, (left - firstColumn) // factor:][:rows, :columns]
+        if cached is not None and cached[0] == (region, factor) and cached[1] is data:
+            cached[3][radius] = detail
+        return detail
+
+    def reduceRegion(self, data, factor):
+        if factor == 1:
+            return np.ascontiguousarray(data)
+        return np.asarray(Image.fromarray(np.ascontiguousarray(data), "RGB").reduce(factor))
+
+    def outputBuffer(self, key, shape):
+        # Buffers are pooled per key as [buffer, lent, wrappers]. A render is lent to its caller until a QImage wraps
+        # it, then it is in use while one of those QImages is alive or the render cache holds it. A render nobody
+        # wraps stays lent, it is never written over while the caller may hold it
+        with self.bufferLock:
+            cached = [rendered[1] for rendered in list(self.renders.values())]
+            buffers = self.outputBuffers.setdefault(key, [])
+            for index in reversed(range(len(buffers))):
+                buffer, lent, wrappers = buffers[index]
+                if lent or any(wrapper() is not None for wrapper in wrappers) \
+                        or any(data is buffer for data in cached):
+                    continue
+                if buffer.shape == shape:
+                    buffers[index] = [buffer, True, []]
+                    return buffer
+                del buffers[index]
+            buffer = self.storage.allocate(shape)
+            buffers.append([buffer, True, []])
+            return buffer
+
+    def lendBuffer(self, data):
+        # A cached render handed out again is lent like a new one
+        with self.bufferLock:
+            for entry in self.pooledBuffers(data):
+                entry[1] = True
+
+    def wrapBuffer(self, data, image):
+        # image wraps data, a pooled buffer or a view of one, the buffer stays in use for as long as image is alive
+        with self.bufferLock:
+            for entry in self.pooledBuffers(data):
+                entry[1] = False
+                wrappers = [wrapper for wrapper in entry[2] if wrapper() is not None and wrapper() is not image]
+                entry[2] = wrappers + [weakref.ref(image)]
+
+    def pooledBuffers(self, data):
+        return [entry for buffers in self.outputBuffers.values() for entry in buffers
+                if np.may_share_memory(entry[0], data)]
+
+    def allocationStats(self):
+        return {"imageAllocations": self.storage.allocations, "imageBytes": self.storage.allocatedBytes,
+                "scratchAllocations": self.tileScheduler.scratchAllocations}
+
+    def image(self, proxy=False, settings=None, cropped=False):
+        # The same render always comes back as the same QImage, so its cacheKey identifies the pixels
+        key = self.renderKey(proxy, cropped)
+        data = self.render(proxy, settings, cropped)
+        cached = self.images.get(key)
+        if cached is not None and cached[0] is data:
+            self.wrapBuffer(data, cached[1])
+            return cached[1]
+        image = arrayToQImage(data)
+        self.wrapBuffer(data, image)
+        self.images[key] = (data, image)
+        return image
+
+    def regionImage(self, region, factor=1, proxy=False, settings=None, cropped=False):
+        data = self.renderRegion(region, factor, proxy, settings, cropped)
+        image = arrayToQImage(data)
+        self.wrapBuffer(data, image)
+        return image
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+from PIL import Image
+
+from AdjustmentPipeline import ADJUSTMENTS, EXPORT_PRECISION, PRECISIONS, AdjustmentPipeline
+from CropResampler import DEFAULT_INTERPOLATION, INTERPOLATIONS
+from ExportPresets import downscale, presetVariants
+from ImageExporter import writeImage
+from ImageSource import ImageSource
+from ImageStorage import DEFAULT_MEMORY_BUDGET, ImageStorage
+from Orientation import Orientation
+from TileScheduler import TileScheduler
+
+
+JOURNAL_NAME = ".bie-batch.jsonl"
+
+worker = {}
+
+
+def loadRecipe(recipeFile):
+    # A recipe holds the edit as the GUI makes it: adjustment settings, an orientation, a crop either relative to
+    # the oriented image ("center" and "size" as fractions) or in its pixels ("pixels" as center x, center y,
+    # width, height, rotation), and optionally the interpolation, the precision (EXPORT_PRECISION by default) and
+    # export presets
+    with open(recipeFile) as file:
+        recipe = json.load(file)
+    if not isinstance(recipe, dict):
+        raise ValueError("a recipe is a JSON object")
+    settings = recipe.get("settings", {})
+    if not isinstance(settings, dict) or not all(isNumber(value) for value in settings.values()):
+        raise ValueError("settings are an object of numbers")
+    unknown = set(settings) - set(ADJUSTMENTS)
+    if unknown:
+        raise ValueError("unknown adjustments " + ", ".join(sorted(unknown)))
+    if recipe.get("interpolation", DEFAULT_INTERPOLATION) not in INTERPOLATIONS:
+        raise ValueError("unknown interpolation {!r}".format(recipe["interpolation"]))
+    if recipe.get("precision") is not None and recipe["precision"] not in PRECISIONS:
+        raise ValueError("unknown precision {!r}".format(recipe["precision"]))
+
+    orientation = recipe.get("orientation", {})
+    if not isinstance(orientation, dict) or not isinstance(orientation.get("turns", 0), int) \
+            or not isinstance(orientation.get("flipped", False), bool):
+        raise ValueError("orientation is an object with integer turns and boolean flipped")
+    crop = recipe.get("crop")
+    if crop is not None:
+        if not isinstance(crop, dict):
+            raise ValueError("crop is an object")
+        if "pixels" in crop:
+            if not isNumbers(crop["pixels"], 5):
+                raise ValueError("crop pixels are center x, center y, width, height and rotation")
+        elif not isNumbers(crop.get("center", (0.5, 0.5)), 2) or not isNumbers(crop.get("size", (1, 1)), 2) \
+                or not isNumber(crop.get("rotation", 0)):
+            raise ValueError("a relative crop has a center and a size of two numbers and a rotation")
+    presets = recipe.get("presets")
+    if presets is not None:
+        keys = {"suffix", "extension", "size", "options"}
+        if not isinstance(presets, list) or not all(isinstance(preset, dict) and keys <= set(preset)
+                                                    for preset in presets):
+            raise ValueError("presets are a list of objects with " + ", ".join(sorted(keys)))
+    return recipe
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def isNumbers(values, count):
+    return isinstance(values, (list, tuple)) and len(values) == count and all(isNumber(value) for value in values)
+
+
+def recipePipeline(source, recipe, precision, storage=None, tileScheduler=None):
+    pipeline = AdjustmentPipeline(source, storage, precision, recipe.get("interpolation", DEFAULT_INTERPOLATION),
+                                  tileScheduler)
+    pipeline.settings.update(recipe.get("settings", {}))
+    orientation = recipe.get("orientation", {})
+    pipeline.setOrientation(Orientation(orientation.get("turns", 0), orientation.get("flipped", False)))
+
+    crop = recipe.get("crop")
+    if crop is not None:
+        if "pixels" in crop:
+            pipeline.setCrop(tuple(crop["pixels"]))
+        else:
+            width, height = pipeline.orientedSize()
+            centerX, centerY = crop.get("center", (0.5, 0.5))
+            cropWidth, cropHeight = crop.get("size", (1, 1))
+            pipeline.setCrop((centerX * width, centerY * height, cropWidth * width, cropHeight * height,
+                              crop.get("rotation", 0)))
+    return pipeline
+
+
+def recipeVariants(recipe, outputDirectory, imageFile):
+    # Without presets every image is written once at full resolution in its own format, like Save in the GUI
+    presets = recipe.get("presets")
+    if presets is None:
+        extension = os.path.splitext(imageFile)[1].lstrip(".")
+        presets = [{"suffix": "", "extension": extension, "size": None, "options": None}]
+    return presetVariants(outputDirectory, imageFile, presets)
+
+
+def outputClashes(imageVariants):
+    # Outputs are named after the stem of their input, photo.jpg and photo.png would both write photo_web.webp and
+    # the second would replace the first. Returns every path more than one variant writes with the images writing it
+    writers = {}
+    for imageFile, variants in imageVariants.items():
+        for path, size, options in variants:
+            writers.setdefault(os.path.normcase(os.path.abspath(path)), []).append(imageFile)
+    return {path: writing for path, writing in writers.items() if len(writing) > 1}
+
+
+def recipeKey(recipe, precision):
+    return hashlib.sha1(json.dumps([recipe, precision], sort_keys=True).encode()).hexdigest()
+
+
+def initWorker(memoryBudget):
+    # Every process works on one image at a time with a single tile worker, the pool provides the parallelism
+    worker["storage"] = ImageStorage(memoryBudget)
+    worker["tileScheduler"] = TileScheduler(1)
+
+
+def processImage(task):
+    imageFile, variants, recipe, precision = task
+    start = time.perf_counter()
+    try:
+        source = ImageSource(imageFile, worker["storage"])
+        pipeline = recipePipeline(source, recipe, precision, worker["storage"], worker["tileScheduler"])
+        image = Image.fromarray(pipeline.render(cropped=True), "RGB")
+        for path, size, options in variants:
+            writeImage(downscale(image, size), path, options)
+    except Exception as exception:
+        return imageFile, False, time.perf_counter() - start, str(exception)
+    return imageFile, True, time.perf_counter() - start, None
+
+
+def imageFiles(directory):
+    extensions = Image.registered_extensions()
+    return sorted(entry.path for entry in os.scandir(directory)
+                  if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions)
+
+
+def readJournal(journalFile, key):
+    # The journal lists every image finished under a recipe, an interrupted batch skips those whose files are
+    # all still there. Files are only ever renamed into place complete, so an existing file is a finished one
+    finished = set()
+    if not os.path.exists(journalFile):
+        return finished
+    with open(journalFile) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("recipe") == key and all(os.path.exists(path) for path in entry.get("outputs", [])):
+                finished.add(entry["input"])
+    return finished
+
+
+def removePartialFiles(directory):
+    for entry in os.scandir(directory):
+        if entry.name.startswith(".") and entry.name.endswith(".part"):
+            os.remove(entry.path)
+
+
+def runBatch(recipe, inputDirectory, outputDirectory, maxImages=None, restart=False,
+             memoryBudget=DEFAULT_MEMORY_BUDGET):
+    # recipe is what loadRecipe returned, memoryBudget is shared by the processes or None for no limit
+    os.makedirs(outputDirectory, exist_ok=True)
+    if os.path.samefile(inputDirectory, outputDirectory):
+        print("the output directory has to differ from the input directory")
+        return 2
+
+    # Unless the recipe names an engine every process renders in EXPORT_PRECISION, like Save and Export in the GUI,
+    # so a batch gives the same pixels as saving the same edit by hand
+    precision = recipe.get("precision") or EXPORT_PRECISION
+    images = imageFiles(inputDirectory)
+    imageVariants = {imageFile: recipeVariants(recipe, outputDirectory, imageFile) for imageFile in images}
+    clashes = outputClashes(imageVariants)
+    if clashes:
+        for path, writing in list(clashes.items())[:10]:
+            print("{} would be written from {}".format(path, " and ".join(os.path.basename(imageFile)
+                                                                          for imageFile in writing)))
+        print("{} output files would be written more than once, rename the images or give the presets distinct "
+              "suffixes".format(len(clashes)))
+        return 2
+
+    key = recipeKey(recipe, precision)
+    journalFile = os.path.join(outputDirectory, JOURNAL_NAME)
+    if restart and os.path.exists(journalFile):
+        os.remove(journalFile)
+    removePartialFiles(outputDirectory)
+    finished = readJournal(journalFile, key)
+
+    tasks = [(imageFile, imageVariants[imageFile], recipe, precision)
+             for imageFile in images if os.path.basename(imageFile) not in finished]
+    print("{} images, {} already done, {} to process".format(len(images), len(images) - len(tasks), len(tasks)))
+    if not tasks:
+        return 0
+
+    # At most one image per process is decoded at a time, so maxImages bounds the pool and the memory it needs
+    processes = max(1, min(os.cpu_count() or 1, maxImages or os.cpu_count() or 1, len(tasks)))
+    variants = {task[0]: [path for path, size, options in task[1]] for task in tasks}
+    failures = 0
+    start = time.perf_counter()
+    budget = None if memoryBudget is None else memoryBudget // processes
+    with multiprocessing.Pool(processes, initWorker, (budget,)) as pool, \
+            open(journalFile, "a") as journal:
+        for done, (imageFile, succeeded, duration, error) in enumerate(
+                pool.imap_unordered(processImage, tasks), 1):
+            name = os.path.basename(imageFile)
+            if succeeded:
+                journal.write(json.dumps({"input": name, "recipe": key, "outputs": variants[imageFile]}) + "\n")
+                journal.flush()
+                print("[{}/{}] {} ({:.2f} s)".format(done, len(tasks), name, duration))
+            else:
+                failures += 1
+                print("[{}/{}] {} failed: {}".format(done, len(tasks), name, error))
+
+    print("processed {} images in {:.1f} s with {} processes, {} failed".format(
+        len(tasks), time.perf_counter() - start, processes, failures))
+    return 1 if failures else 0
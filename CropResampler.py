@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+
+from Orientation import Orientation
+
+
+INTERPOLATIONS = ("nearest", "bilinear", "bicubic")
+DEFAULT_INTERPOLATION = "bilinear"
+BICUBIC_SHARPNESS = -0.5
+
+
+def cropScale(sourceShape, dataShape, orientation):
+    return orientation.size(dataShape[1] / sourceShape[1], dataShape[0] / sourceShape[0])
+
+
+def cropShape(crop, sourceShape, dataShape, orientation=Orientation()):
+    centerX, centerY, width, height, rotation = crop
+    xScale, yScale = cropScale(sourceShape, dataShape, orientation)
+    return max(1, int(height * yScale)), max(1, int(width * xScale)), 3
+
+
+def cropTransform(crop, sourceShape, dataShape, orientation=Orientation()):
+    # Maps the centers of the output pixels back into data, as the sample position of output pixel (0, 0) and the
+    # steps for one output column and one output row. The crop is in the coordinates of the source after the
+    # orientation, and the output is at the scale of data, which may be a downscaled copy of the source
+    centerX, centerY, width, height, rotation = crop
+    xScale, yScale = cropScale(sourceShape, dataShape, orientation)
+    angle = math.radians(rotation)
+    cos, sin = math.cos(angle), math.sin(angle)
+    toSource = np.linalg.inv(orientation.matrix(sourceShape[1], sourceShape[0]))
+
+    def position(column, row):
+        offsetX = column / xScale - width / 2
+        offsetY = row / yScale - height / 2
+        x, y, _ = toSource @ (centerX + offsetX * cos - offsetY * sin, centerY + offsetX * sin + offsetY * cos, 1)
+        return x * dataShape[1] / sourceShape[1] - 0.5, y * dataShape[0] / sourceShape[0] - 0.5
+
+    originX, originY = position(0.5, 0.5)
+    columnX, columnY = position(1.5, 0.5)
+    rowX, rowY = position(0.5, 1.5)
+    return (originX, originY), (columnX - originX, columnY - originY), (rowX - originX, rowY - originY)
+
+
+def alignedCrop(crop, sourceShape, dataShape, orientation):
+    # An unrotated crop whose corner lands on a whole pixel of data samples every pixel exactly in every
+    # interpolation, it is then a plain slice of the oriented view of data
+    centerX, centerY, width, height, rotation = crop
+    if rotation:
+        return None
+    xScale, yScale = cropScale(sourceShape, dataShape, orientation)
+    left, top = (centerX - width / 2) * xScale, (centerY - height / 2) * yScale
+    if abs(left - round(left)) > 1e-6 or abs(top - round(top)) > 1e-6:
+        return None
+    return round(left), round(top)
+
+
+def cubicWeights(fraction):
+    # Keys cubic convolution weights for the taps at -1, 0, 1 and 2
+    weights = []
+    for distance in (1 + fraction, fraction, 1 - fraction, 2 - fraction):
+        near = ((BICUBIC_SHARPNESS + 2) * distance - (BICUBIC_SHARPNESS + 3)) * distance * distance + 1
+        far = ((BICUBIC_SHARPNESS * distance - 5 * BICUBIC_SHARPNESS) * distance + 8 * BICUBIC_SHARPNESS) * distance \
+            - 4 * BICUBIC_SHARPNESS
+        weights.append(np.where(distance <= 1, near, far))
+    return weights
+
+
+def resampleRows(data, out, top, bottom, transform, interpolation):
+    # Every output pixel is computed from its own position only, so the result does not depend on how the rows are
+    # split between workers. Samples that fall outside data are white, like the canvas the crop used to be drawn on
+    (originX, originY), column, row = transform
+    height, width = data.shape[:2]
+    columns = np.arange(out.shape[1], dtype=np.float64)
+    rows = np.arange(top, bottom, dtype=np.float64)[:, None]
+    x = originX + columns * column[0] + rows * row[0]
+    y = originY + columns * column[1] + rows * row[1]
+    inside = (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+
+    if interpolation == "nearest":
+        xIndex = np.clip(np.floor(x + 0.5), 0, width - 1).astype(np.intp)
+        yIndex = np.clip(np.floor(y + 0.5), 0, height - 1).astype(np.intp)
+        values = data[yIndex, xIndex]
+    else:
+        xStart, yStart = np.floor(x), np.floor(y)
+        xFraction = (x - xStart).astype(np.float32)[:, :, None]
+        yFraction = (y - yStart).astype(np.float32)[:, :, None]
+        if interpolation == "bilinear":
+            taps = (0, 1)
+            xWeights, yWeights = (1 - xFraction, xFraction), (1 - yFraction, yFraction)
+        else:
+            taps = (-1, 0, 1, 2)
+            xWeights, yWeights = cubicWeights(xFraction), cubicWeights(yFraction)
+
+        xIndices = [np.clip(xStart + tap, 0, width - 1).astype(np.intp) for tap in taps]
+        values = np.zeros(x.shape + (3,), np.float32)
+        for yTap, yWeight in zip(taps, yWeights):
+            yIndex = np.clip(yStart + yTap, 0, height - 1).astype(np.intp)
+            for xIndex, xWeight in zip(xIndices, xWeights):
+                values += data[yIndex, xIndex] * (yWeight * xWeight)
+        np.rint(values, out=values)
+        np.clip(values, 0, 255, out=values)
+
+    target = out[top:bottom]
+    target[...] = 255
+    np.copyto(target, values, casting="unsafe", where=inside[:, :, None])
+
+
+def copyRows(view, out, top, bottom, cropLeft, cropTop):
+    # Whatever part of the crop lies outside the view stays white
+    target = out[top:bottom]
+    target[...] = 255
+    viewTop = min(max(0, cropTop + top), view.shape[0])
+    viewBottom = min(max(0, cropTop + bottom), view.shape[0])
+    viewLeft = min(max(0, cropLeft), view.shape[1])
+    viewRight = min(max(0, cropLeft + out.shape[1]), view.shape[1])
+    rowStart, columnStart = viewTop - cropTop - top, viewLeft - cropLeft
+    target[rowStart:rowStart + viewBottom - viewTop, columnStart:columnStart + viewRight - viewLeft] = \
+        view[viewTop:viewBottom, viewLeft:viewRight]
+
+
+def resampleCrop(data, crop, sourceShape, out, interpolation, tileScheduler, orientation=Orientation()):
+    # Rotations and flips by quarter turns are folded into the affine map, so they cost nothing until a crop of
+    # the image is materialised here
+    aligned = alignedCrop(crop, sourceShape, data.shape, orientation)
+    if aligned is not None:
+        left, top = aligned
+        view = orientation.view(data)
+        tileScheduler.run(out.shape[0], out.shape[1], lambda rowTop, rowBottom: copyRows(
+            view, out, rowTop, rowBottom, left, top))
+        return out
+
+    transform = cropTransform(crop, sourceShape, data.shape, orientation)
+    tileScheduler.run(out.shape[0], out.shape[1], lambda top, bottom: resampleRows(
+        data, out, top, bottom, transform, interpolation))
+    return out
@@ -0,0 +1,30 @@
+import os
+
+from PIL import Image
+
+
+# Every preset is one file written from the same render, size is the longest side in pixels or None for full
+# resolution and options go to the encoder. Every preset has a suffix, so exporting next to the source never writes
+# over it
+EXPORT_PRESETS = [
+    {"name": "full", "suffix": "_full", "extension": "jpg", "size": None, "options": {"quality": 95}},
+    {"name": "web", "suffix": "_web", "extension": "webp", "size": 2048, "options": {"quality": 82, "method": 4}},
+    {"name": "thumbnail", "suffix": "_thumb", "extension": "png", "size": 256, "options": {"optimize": True}},
+]
+
+
+def presetVariants(directory, imageFile, presets=EXPORT_PRESETS):
+    # The variants of imageFile as (path, size, options) for ImageExporter.exportVariants
+    stem = os.path.splitext(os.path.basename(imageFile))[0]
+    return [(os.path.join(directory, stem + preset["suffix"] + "." + preset["extension"]), preset["size"],
+             preset["options"]) for preset in presets]
+
+
+def downscale(image, size):
+    # The box filter averages every source pixel covered by an output pixel by the area it covers, so fine detail
+    # is integrated instead of aliased however far the image is reduced
+    if size is None or max(image.size) <= size:
+        return image
+    scale = size / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                        Image.Resampling.BOX)
@@ -1,8 +1,12 @@
-from PySide6.QtCore import QSize, Signal
-from PySide6.QtGui import QPixmap, Qt, QImage, QResizeEvent
+import math
+
+from PySide6.QtCore import QSize, Signal, QRect, QRectF, QPoint
+from PySide6.QtGui import QPixmap, Qt, QImage, QResizeEvent, QPainter, QPaintEvent
 from PySide6.QtWidgets import QWidget, QLabel, QVBoxLayout, QHBoxLayout, QScrollArea, QFormLayout, QSlider, QPushButton
-import numpy as np
-from PIL import Image
+
+from AdjustmentPipeline import AdjustmentPipeline, DEFAULT_RADIUS, EXPORT_PRECISION, PRECISIONS
+from MipmapPyramid import MipmapPyramid
+from RenderScheduler import RenderScheduler
 
 
 class ImageAdjustTab(QWidget):
@@ -10,6 +14,7 @@ class ImageAdjustTab(QWidget):
         super().__init__()
         self.mainWindow = mainWindow
         self.mainWindow.imageChanged.connect(self.changeImage)
+        self.mainWindow.sourceUpgraded.connect(self.upgradeSource)
         self.mainWindow.stackedWidget.currentChanged.connect(self.updateImage)
         self.mainWindow.zoomInAction.triggered.connect(lambda: self.zoomImage(0.15))
         self.mainWindow.zoomOutAction.triggered.connect(lambda: self.zoomImage(-0.15))
@@ -18,7 +23,6 @@ class ImageAdjustTab(QWidget):
         self.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.setupImageView()
         self.setupAdjustmentPanel()
-        self.xDifference = None
 
         self.setLayout(self.mainLayout)
 
@@ -45,7 +49,8 @@ class ImageAdjustTab(QWidget):
         self.brightnessSlider.setRange(-100, 100)
         self.brightnessSlider.setSingleStep(5)
         self.brightnessSlider.setSliderPosition(0)
-        self.brightnessSlider.valueChanged.connect(lambda value: self.setBrightness(value - self.brightnessSlider.previousValue))
+        self.brightnessSlider.valueChanged.connect(lambda value: self.setAdjustment("brightness", value))
+        self.brightnessSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         brightnessLabel.clicked.connect(lambda : self.brightnessSlider.setValue(0))
 
         contrastLabel = QPushButton(" Contrast")
@@ -57,7 +62,8 @@ class ImageAdjustTab(QWidget):
         self.contrastSlider.setRange(-100, 100)
         self.contrastSlider.setSingleStep(1)
         self.contrastSlider.setSliderPosition(0)
-        self.contrastSlider.valueChanged.connect(lambda value: self.setContrast(value - self.contrastSlider.previousValue))
+        self.contrastSlider.valueChanged.connect(lambda value: self.setAdjustment("contrast", value))
+        self.contrastSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         contrastLabel.clicked.connect(lambda : self.contrastSlider.setValue(0))
 
 
@@ -70,7 +76,8 @@ class ImageAdjustTab(QWidget):
         self.highlightSlider.setRange(-100, 100)
         self.highlightSlider.setSingleStep(5)
         self.highlightSlider.setSliderPosition(0)
-        self.highlightSlider.valueChanged.connect(lambda value: self.setHighlight(value - self.highlightSlider.previousValue))
+        self.highlightSlider.valueChanged.connect(lambda value: self.setAdjustment("highlight", value))
+        self.highlightSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         highlightLabel.clicked.connect(lambda: self.highlightSlider.setValue(0))
 
         shadowsLabel = QPushButton(" Shadows")
@@ -82,7 +89,8 @@ class ImageAdjustTab(QWidget):
         self.shadowsSlider.setRange(-100, 100)
         self.shadowsSlider.setSingleStep(5)
         self.shadowsSlider.setSliderPosition(0)
-        self.shadowsSlider.valueChanged.connect(lambda value: self.setShadows(value - self.shadowsSlider.previousValue))
+        self.shadowsSlider.valueChanged.connect(lambda value: self.setAdjustment("shadows", value))
+        self.shadowsSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         shadowsLabel.clicked.connect(lambda: self.shadowsSlider.setValue(0))
 
         lightAdjustmentLayout.addRow(brightnessLabel, self.brightnessSlider)
@@ -102,7 +110,8 @@ class ImageAdjustTab(QWidget):
         self.saturationSlider.setRange(-100, 100)
         self.saturationSlider.setSingleStep(5)
         self.saturationSlider.setSliderPosition(0)
-        self.saturationSlider.valueChanged.connect(lambda value: self.setSaturation(value - self.saturationSlider.previousValue))
+        self.saturationSlider.valueChanged.connect(lambda value: self.setAdjustment("saturation", value))
+        self.saturationSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         saturationLabel.clicked.connect(lambda: self.saturationSlider.setValue(0))
 
         warmthLabel = QPushButton(" Warmth")
@@ -114,7 +123,8 @@ class ImageAdjustTab(QWidget):
         self.warmthSlider.setRange(-100, 100)
         self.warmthSlider.setSingleStep(5)
         self.warmthSlider.setSliderPosition(0)
-        self.warmthSlider.valueChanged.connect(lambda value: self.setWarmth(value - self.warmthSlider.previousValue))
+        self.warmthSlider.valueChanged.connect(lambda value: self.setAdjustment("warmth", value))
+        self.warmthSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         warmthLabel.clicked.connect(lambda: self.warmthSlider.setValue(0))
 
         colorAdjustmentLayout.addRow(saturationLabel, self.saturationSlider)
@@ -132,10 +142,28 @@ class ImageAdjustTab(QWidget):
         self.sharpnessSlider.setRange(0, 100)
         self.sharpnessSlider.setSingleStep(5)
         self.sharpnessSlider.setSliderPosition(0)
-        self.sharpnessSlider.valueChanged.connect(lambda value: self.setSharpness(value - self.sharpnessSlider.previousValue))
+        self.sharpnessSlider.valueChanged.connect(lambda value: self.setAdjustment("sharpness", value))
+        self.sharpnessSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
         sharpnessLabel.clicked.connect(lambda: self.sharpnessSlider.setValue(0))
 
+        radiusLabel = QPushButton(" Radius")
+        radiusLabel.setIconSize(QSize(20, 20))
+        radiusLabel.setIcon(QPixmap("icon/sharpness.svg"))
+        radiusLabel.setFlat(True)
+        self.radiusSlider = Slider(self.mainWindow)
+        self.radiusSlider.setOrientation(Qt.Horizontal)
+        # The range and default radius are not edits, the slider starts on them without marking the image changed
+        self.radiusSlider.blockSignals(True)
+        self.radiusSlider.setRange(1, 10)
+        self.radiusSlider.setSingleStep(1)
+        self.radiusSlider.setSliderPosition(DEFAULT_RADIUS)
+        self.radiusSlider.blockSignals(False)
+        self.radiusSlider.valueChanged.connect(lambda value: self.setAdjustment("radius", value))
+        self.radiusSlider.sliderReleased.connect(lambda: self.requestRender(proxy=False))
+        radiusLabel.clicked.connect(lambda: self.radiusSlider.setValue(DEFAULT_RADIUS))
+
         textureAdjustmentLayout.addRow(sharpnessLabel, self.sharpnessSlider)
+        textureAdjustmentLayout.addRow(radiusLabel, self.radiusSlider)
 
         adjustmentPanelLayout = QVBoxLayout()
         adjustmentPanelLayout.setContentsMargins(8, 4, 16, 16)
@@ -161,9 +189,13 @@ class ImageAdjustTab(QWidget):
 
 
     def setupImageView(self):
-        self.imageLabel = QLabel()
-        self.imageLabel.setAlignment(Qt.AlignCenter)
-        self.modifiedImageData = np.array(Image.open(self.mainWindow.imageFile), dtype=np.float16)
+        self.imageCanvas = ImageCanvas()
+        # The preview engine chosen in the header, "auto" keeps the one benchmarked as the fastest
+        precision = self.mainWindow.settings.value("precision", "auto")
+        self.pipeline = AdjustmentPipeline(self.mainWindow.source, self.mainWindow.storage,
+                                           precision if precision in PRECISIONS else None)
+        self.renderScheduler = RenderScheduler(self.renderFrame)
+        self.renderScheduler.frameReady.connect(self.showFrame)
 
         self.imageScale = 1
 
@@ -181,36 +213,60 @@ class ImageAdjustTab(QWidget):
         self.imageScrollArea.horizontalScrollBar().rangeChanged.connect(self.adaptCurrentScrollToPrev)
         self.imageScrollArea.resized.connect(self.updateImage)
 
-        self.imageScrollArea.setWidget(self.imageLabel)
+        self.imageScrollArea.setWidget(self.imageCanvas)
         self.mainLayout.addWidget(self.imageScrollArea, 2)
 
     def changeImage(self):
-        self.modifiedImageData = np.array(Image.open(self.mainWindow.imageFile), dtype=np.float16)
-        self.brightnessSlider.setSliderPosition(0)
-        self.contrastSlider.setValue(0)
-        self.highlightSlider.setValue(0)
-        self.shadowsSlider.setValue(0)
-        self.saturationSlider.setValue(0)
-        self.warmthSlider.setValue(0)
-        self.sharpnessSlider.setValue(0)
-        self.xDifference = None
+        if self.pipeline.source is self.mainWindow.source:
+            self.pipeline.resetSource()
+        else:
+            self.pipeline.loadSource(self.mainWindow.source)
+        self.resetAdjustments()
+
+    def upgradeSource(self):
+        self.pipeline.upgradeSource(self.mainWindow.source)
         self.updateImage()
 
-    def updateImage(self):
-        try:
-            self.image = self.mainWindow.imageCropWidget.cropedImage()
-            print('updated image')
-        except:
-            self.image = self.mainWindow.modifiedImage
-            print('error')
-        if self.image.width() > self.imageScrollArea.width() or self.image.height() > self.imageScrollArea.height():
-            image = self.image.scaled(self.imageScrollArea.width(), self.imageScrollArea.height(), Qt.KeepAspectRatio,
-                                              Qt.SmoothTransformation)
-        else:
-            image = self.image
-        image = image.scaledToHeight(image.height()*self.imageScale)
-        self.imageLabel.setPixmap(QPixmap.fromImage(image))
+    def setPrecision(self, precision):
+        self.pipeline.setPrecision(precision)
+        self.updateImage()
+        self.commitChanges()
+
+    def resetAdjustments(self):
+        self.pipeline.resetSettings()
+        for name, slider in self.adjustmentSliders().items():
+            slider.blockSignals(True)
+            slider.setValue(self.pipeline.settings[name])
+            slider.blockSignals(False)
+        self.updateImage()
+
+    def adjustmentSliders(self):
+        return {"brightness": self.brightnessSlider, "contrast": self.contrastSlider,
+                "highlight": self.highlightSlider, "shadows": self.shadowsSlider,
+                "saturation": self.saturationSlider, "warmth": self.warmthSlider,
+                "sharpness": self.sharpnessSlider, "radius": self.radiusSlider}
 
+    def updateImage(self):
+        self.pipeline.setProxySize(max(self.imageScrollArea.width(), self.imageScrollArea.height()))
+        self.pipeline.setCrop(self.mainWindow.imageCropWidget.cropGeometry())
+        if self.pipeline.isRendered(cropped=True):
+            self.showImage(self.pipeline.image(cropped=True))
+            return
+        # The proxy is shown right away, zoomed in past it the full resolution render follows from the worker
+        self.showImage(self.pipeline.image(True, cropped=True))
+        if self.isVisible() and self.displayScale() > self.pipeline.proxyScale():
+            self.requestRender(proxy=False)
+
+    def showImage(self, image):
+        self.image = image
+        cropRect = self.mainWindow.imageCropWidget.imageCrop.cropRect
+        height = round(cropRect.height() * self.displayScale())
+        self.imageCanvas.setImage(image, QSize(round(height * image.width() / image.height()), height))
+
+    def displayScale(self):
+        cropRect = self.mainWindow.imageCropWidget.imageCrop.cropRect
+        fitScale = min(1, self.imageScrollArea.width() / cropRect.width(), self.imageScrollArea.height() / cropRect.height())
+        return fitScale * self.imageScale
 
     def zoomImage(self, scaleAdded):
         if self.isVisible():
@@ -249,100 +305,77 @@ class ImageAdjustTab(QWidget):
         self.imageScrollArea.horizontalScrollBar().setSliderPosition(hScrollMax * self.prevHScrollPos / self.prevHScrollMax)
 
 
-    def setBrightness(self, value):
-        self.modifiedImageData[:, :, :] += value
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255, np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setContrast(self, value):
-        mean = 128
-        factor = (259*(value + 255))/(255*(259-value))
-        self.modifiedImageData[:, :, :] = factor * (self.modifiedImageData[:, :, :] - mean) + mean
-
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255, np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setHighlight(self, value):
-        factor = (259 * (value + 255)) / (255 * (259 - value))
-        self.modifiedImageData[:, :, :] = np.where(self.modifiedImageData[:, :, :] > 140,
-                                                   factor * (self.modifiedImageData[:, :, :] - 140) + 140,
-                                                   self.modifiedImageData[:, :, :])
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setShadows(self, value):
-        value /= 3
-        self.modifiedImageData[:, :, :] = np.where(self.modifiedImageData[:, :, :] < 140,
-                                                    self.modifiedImageData[:, :, :] + value,
-                                                   self.modifiedImageData[:, :, :])
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setWarmth(self, value):
-        self.modifiedImageData[:, :, 0] += value
-        self.modifiedImageData[:, :, 1] += (value*0.65)
-
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setSaturation(self, value):
-        meanByPixel = self.modifiedImageData.mean(2)
-        factor = (259 * (value + 255)) / (255 * (259 - value))
-
-        self.modifiedImageData[:, :, 0] = factor * (self.modifiedImageData[:, :, 0] - meanByPixel) + meanByPixel
-        self.modifiedImageData[:, :, 1] = factor * (self.modifiedImageData[:, :, 1] - meanByPixel) + meanByPixel
-        self.modifiedImageData[:, :, 2] = factor * (self.modifiedImageData[:, :, 2] - meanByPixel) + meanByPixel
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def setSharpness(self, value):
-        if not type(self.xDifference) == np.ndarray:
-            self.xDifference = np.diff(self.modifiedImageData, axis=0)
-            self.xDifference = np.concatenate((np.array([[[0, 0, 0]]*self.xDifference.shape[1]]), self.xDifference), axis=0)
-
-        #value *= 2
-        self.modifiedImageData = self.modifiedImageData + (self.xDifference*(value/10))
-
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
-
-        self.mainWindow.modifiedImage = Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
-        self.updateImage()
-
-    def getImage(self):
-        cappedData = np.array(self.modifiedImageData, copy=True)
-        cappedData[:, :, :] = np.where(cappedData[:, :, :] > 255, 255,
-                                       np.where(cappedData[:, :, :] < 0, 0, cappedData[:, :, :]))
+    def setAdjustment(self, name, value):
+        self.pipeline.settings[name] = value
+        self.requestRender(proxy=any(slider.isSliderDown() for slider in self.adjustmentSliders().values()))
+
+    def requestRender(self, proxy):
+        if not proxy and self.pipeline.isRendered(cropped=True):
+            return
+        self.pipeline.setProxySize(max(self.imageScrollArea.width(), self.imageScrollArea.height()))
+        if self.displayScale() > self.pipeline.proxyScale():
+            proxy = False
+        region = None if proxy else self.visibleRegion()
+        self.renderScheduler.submit((self.pipeline.generation, dict(self.pipeline.settings), proxy, region, True))
+
+    def visibleRegion(self):
+        # The on screen part of the full resolution render as (top, left, bottom, right) and the box reduction that
+        # brings it down to about display resolution, None when all of the render shows
+        imageRect = self.imageCanvas.imageRect()
+        visible = self.imageCanvas.visibleRegion().boundingRect().intersected(imageRect)
+        if visible.isEmpty() or visible == imageRect:
+            return None
+        scale = self.displayScale()
+        factor = max(1, int(1 / scale))
+        top = math.floor((visible.top() - imageRect.top()) / scale / factor) * factor
+        left = math.floor((visible.left() - imageRect.left()) / scale / factor) * factor
+        bottom = math.ceil((visible.bottom() + 1 - imageRect.top()) / scale / factor) * factor
+        right = math.ceil((visible.right() + 1 - imageRect.left()) / scale / factor) * factor
+        return (top, left, bottom, right), factor
+
+    def renderFrame(self, request):
+        # Runs on the render worker, the frame is handed back to showFrame on the GUI thread
+        generation, settings, proxy, region, cropped = request
+        key = self.pipeline.renderKey(proxy, cropped)
+        if region is not None:
+            image = self.pipeline.regionImage(region[0], region[1], proxy, settings, cropped)
+            return generation, settings, key, image, region, cropped
+        return generation, settings, key, self.pipeline.image(proxy, settings, cropped), None, cropped
+
+    def showFrame(self, frame):
+        generation, settings, key, image, region, cropped = frame
+        if generation != self.pipeline.generation:
+            # The uncropped render does not depend on the crop, turning or cropping while it ran only outdated its
+            # generation
+            if not cropped:
+                self.commitChanges()
+            return
+        if region is not None:
+            # Only the visible part is up to date, the rest is filled in once no slider is being dragged
+            (top, left, bottom, right), factor = region
+            scale = self.displayScale() * factor
+            self.imageCanvas.setOverlay(image, QRectF(left / factor * scale, top / factor * scale,
+                                                      image.width() * scale, image.height() * scale))
+            if self.isVisible() and not any(slider.isSliderDown() for slider in self.adjustmentSliders().values()):
+                self.renderScheduler.submit((generation, settings, False, None, True))
+            return
+        if key == "full" and settings == self.pipeline.settings:
+            self.mainWindow.modifiedImage = image
+            self.mainWindow.imageCropWidget.loadChanges()
+        if cropped:
+            self.showImage(image)
+
+    def commitChanges(self):
+        # The crop view shows the last committed image until the uncropped render of the adjustments comes back
+        if self.pipeline.isRendered():
+            self.mainWindow.modifiedImage = self.pipeline.image()
+            self.mainWindow.imageCropWidget.loadChanges()
+        else:
+            self.renderScheduler.submit((self.pipeline.generation, dict(self.pipeline.settings), False, None, False))
 
-        return Image.fromarray(cappedData.astype(np.uint8), "RGB").toqimage()
+    def exportPipeline(self):
+        self.pipeline.setCrop(self.mainWindow.imageCropWidget.cropGeometry())
+        return self.pipeline.snapshot(EXPORT_PRECISION)
 
 class Slider(QSlider):
     def __init__(self, mainWindow):
@@ -353,7 +386,7 @@ class Slider(QSlider):
         self.valueChanged.connect(self.setPreviousValue)
 
     def setPreviousValue(self):
-        self.mainWindow.changesSaved = False
+        self.mainWindow.markChanged()
         self.previousValue = self.currentValue
         self.currentValue = self.value()
 
@@ -366,5 +399,54 @@ class ScrollArea(QScrollArea):
             self.resized.emit()
 
 
-
-
+class ImageCanvas(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.image = None
+        self.imageSize = QSize(0, 0)
+        self.pyramid = MipmapPyramid()
+        self.overlay = None
+        self.overlayRect = QRectF()
+
+    def setImage(self, image, size):
+        self.image = image
+        self.overlay = None
+        if size != self.imageSize:
+            self.imageSize = size
+            self.updateGeometry()
+        self.update()
+
+    def setOverlay(self, image, rect):
+        # rect places the overlay in image coordinates, it covers the image until the next setImage
+        self.overlay = image
+        self.overlayRect = rect
+        self.update()
+
+    def imageRect(self):
+        return QRect(QPoint((self.width() - self.imageSize.width()) // 2,
+                            (self.height() - self.imageSize.height()) // 2), self.imageSize)
+
+    def sizeHint(self):
+        return self.imageSize
+
+    def minimumSizeHint(self):
+        return self.imageSize
+
+    def paintEvent(self, event: QPaintEvent):
+        # Only the exposed part of the canvas is drawn, it is sampled from the pyramid level closest to the
+        # display size so nothing the size of the zoomed image is ever allocated
+        if self.image is None or self.imageSize.isEmpty():
+            return
+        imageRect = self.imageRect()
+        target = event.rect().intersected(imageRect)
+        level = self.pyramid.level(self.image, self.imageSize.height())
+        xScale = level.width() / self.imageSize.width()
+        yScale = level.height() / self.imageSize.height()
+        source = QRectF((target.x() - imageRect.x()) * xScale, (target.y() - imageRect.y()) * yScale,
+                        target.width() * xScale, target.height() * yScale)
+
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(QRectF(target), level, source)
+        if self.overlay is not None:
+            painter.drawImage(self.overlayRect.translated(imageRect.topLeft()), self.overlay)
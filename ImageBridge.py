@@ -0,0 +1,12 @@
+import numpy as np
+from PySide6.QtGui import QImage
+
+
+def arrayToQImage(data):
+    # The QImage wraps the array memory without copying, PySide holds a reference to the array for as long as
+    # the QImage is alive. PySide only takes C-contiguous buffers, flipped, strided or column sliced views are copied
+    # first
+    if not data.flags.c_contiguous:
+        data = np.ascontiguousarray(data)
+    height, width = data.shape[:2]
+    return QImage(data, width, height, data.strides[0], QImage.Format_RGB888)
@@ -1,18 +1,23 @@
 import math
 
-from PySide6.QtCore import QRect, QSize, QPoint, QPointF
+from PySide6.QtCore import QRect, QSize, QPointF, QRectF
 from PySide6.QtGui import QPixmap, Qt, QImage, QPaintEvent, QPainter, QPen, QColor, QMouseEvent, QCursor, QBrush, QIcon, \
-    QTransform, QPolygon, QKeyEvent
+    QKeyEvent
 from PySide6.QtWidgets import QWidget, QLabel, QVBoxLayout, QApplication, QPushButton, QHBoxLayout, QComboBox, QSlider
 import numpy as np
 from PIL import Image
 
+from CropResampler import DEFAULT_INTERPOLATION, INTERPOLATIONS
+from MipmapPyramid import MipmapPyramid
+from Orientation import Orientation
+
 
 class ImageCropTab(QWidget):
     def __init__(self, mainWindow):
         super().__init__()
         self.mainWindow = mainWindow
         self.mainWindow.imageChanged.connect(self.updateImage)
+        self.mainWindow.sourceUpgraded.connect(self.upgradeSource)
         self.mainWindow.stackedWidget.currentChanged.connect(self.loadChanges)
         self.imageCrop = ImageCrop(self.mainWindow.modifiedImage)
 
@@ -51,6 +56,13 @@ class ImageCropTab(QWidget):
         self.cropRatio.addItem(QIcon('icon/16x9crop.svg'), '16:9')
         self.cropRatio.currentTextChanged.connect(self.imageCrop.changeCropRatio)
 
+        self.interpolation = QComboBox()
+        self.interpolation.setToolTip('Resampling of rotated crops')
+        for interpolation in INTERPOLATIONS:
+            self.interpolation.addItem(interpolation.capitalize())
+        self.interpolation.setCurrentIndex(INTERPOLATIONS.index(DEFAULT_INTERPOLATION))
+        self.interpolation.currentIndexChanged.connect(self.changeInterpolation)
+
         self.flipVerButton = QPushButton()
         self.flipVerButton.setIcon(QPixmap("icon/flipver.svg"))
         self.flipVerButton.setIconSize(QSize(24, 24))
@@ -67,6 +79,7 @@ class ImageCropTab(QWidget):
         transformLayout.addWidget(self.rotateRightButton)
         transformLayout.addStretch()
         transformLayout.addWidget(self.cropRatio)
+        transformLayout.addWidget(self.interpolation)
         transformLayout.addStretch()
         transformLayout.addWidget(self.flipVerButton)
         transformLayout.addWidget(self.flipHorButton)
@@ -76,50 +89,66 @@ class ImageCropTab(QWidget):
         mainLayout.addLayout(transformLayout)
         self.setLayout(mainLayout)
 
-    def cropedImage(self):
-        self.imageCrop.image = self.mainWindow.modifiedImage
-        return self.imageCrop.cropedImage()
+    def cropGeometry(self):
+        return self.imageCrop.cropGeometry()
 
     def rotateLeft(self):
-        self.mainWindow.imageAdjustWidget.modifiedImageData = np.rot90(self.mainWindow.imageAdjustWidget.modifiedImageData)
-        self.imageCrop.cropRect.pivotLeft(self.mainWindow.modifiedImage.width())
-        self.mainWindow.modifiedImage = self.mainWindow.imageAdjustWidget.getImage()
-        self.loadChanges()
-        self.imageCrop.update()
+        # Turning and flipping only change the orientation, the image shown is the same full render drawn through
+        # another painter transform
+        pipeline = self.mainWindow.imageAdjustWidget.pipeline
+        self.imageCrop.cropRect.pivotLeft(self.imageCrop.imageWidth())
+        pipeline.rotate(1)
+        self.imageCrop.setOrientation(pipeline.orientation)
 
     def rotateRight(self):
-        self.mainWindow.imageAdjustWidget.modifiedImageData = np.rot90(self.mainWindow.imageAdjustWidget.modifiedImageData, -1)
-        self.imageCrop.cropRect.pivotRight(self.mainWindow.modifiedImage.height())
-        self.mainWindow.modifiedImage = self.mainWindow.imageAdjustWidget.getImage()
-        self.loadChanges()
-        self.imageCrop.update()
+        pipeline = self.mainWindow.imageAdjustWidget.pipeline
+        self.imageCrop.cropRect.pivotRight(self.imageCrop.imageHeight())
+        pipeline.rotate(-1)
+        self.imageCrop.setOrientation(pipeline.orientation)
+
 
+    def changeInterpolation(self, index):
+        # Only the cropped renders are resampled, the crop view shows the uncropped render and stays as it is
+        self.mainWindow.imageAdjustWidget.pipeline.setInterpolation(INTERPOLATIONS[index])
+        self.mainWindow.markChanged()
 
     def flipHor(self):
-        self.mainWindow.imageAdjustWidget.modifiedImageData = np.flip(
-            self.mainWindow.imageAdjustWidget.modifiedImageData, axis=1)
-        self.mainWindow.modifiedImage = self.mainWindow.imageAdjustWidget.getImage()
-        self.updateImage()
+        pipeline = self.mainWindow.imageAdjustWidget.pipeline
+        pipeline.flip(1)
+        self.rotationSlider.setSliderPosition(0)
+        self.imageCrop.setImage(self.mainWindow.modifiedImage, pipeline.orientation, self.sourceSize())
 
     def flipVer(self):
-        self.mainWindow.imageAdjustWidget.modifiedImageData = np.flip(
-            self.mainWindow.imageAdjustWidget.modifiedImageData, axis=0)
-        self.mainWindow.modifiedImage = self.mainWindow.imageAdjustWidget.getImage()
-        self.updateImage()
+        pipeline = self.mainWindow.imageAdjustWidget.pipeline
+        pipeline.flip(0)
+        self.rotationSlider.setSliderPosition(0)
+        self.imageCrop.setImage(self.mainWindow.modifiedImage, pipeline.orientation, self.sourceSize())
 
     def loadChanges(self):
         if self.isVisible():
             self.imageCrop.image = self.mainWindow.modifiedImage
+            self.imageCrop.update()
 
     def updateImage(self):
         self.rotationSlider.setSliderPosition(0)
-        self.imageCrop.setImage(self.mainWindow.modifiedImage)
+        self.imageCrop.setImage(self.mainWindow.modifiedImage, size=self.sourceSize())
+
+    def upgradeSource(self):
+        self.imageCrop.setSourceSize(self.sourceSize())
+        self.imageCrop.image = self.mainWindow.modifiedImage
+        self.imageCrop.update()
+
+    def sourceSize(self):
+        return QSize(self.mainWindow.source.width(), self.mainWindow.source.height())
 
 
 class ImageCrop(QWidget):
     def __init__(self, image):
         super().__init__()
         self.image = image
+        self.sourceSize = image.size()
+        self.orientation = Orientation()
+        self.pyramid = MipmapPyramid()
         self.cropRect = CropRectangle(0, 0, image.width(), image.height())
         self.padding = 56
         self.cropHandleRects = []
@@ -136,11 +165,30 @@ class ImageCrop(QWidget):
         self.shiftHeld = False
         self.selectedhandle = ""
 
-    def setImage(self, image):
+    def setImage(self, image, orientation=Orientation(), size=None):
+        # The crop is in pixels of the source, which the image shown may be a lower resolution render of
         self.image = image
-        self.cropRect = CropRectangle(0, 0, image.width(), image.height())
+        self.sourceSize = size or image.size()
+        self.orientation = orientation
+        self.cropRect = CropRectangle(0, 0, self.imageWidth(), self.imageHeight())
+        self.update()
+
+    def setSourceSize(self, size):
+        self.cropRect.scale(size.width() / self.sourceSize.width())
+        self.sourceSize = size
+        self.fixCropOverflow()
         self.update()
 
+    def setOrientation(self, orientation):
+        self.orientation = orientation
+        self.update()
+
+    def imageWidth(self):
+        return self.orientation.size(self.sourceSize.width(), self.sourceSize.height())[0]
+
+    def imageHeight(self):
+        return self.orientation.size(self.sourceSize.width(), self.sourceSize.height())[1]
+
     def rotateCrop(self, value):
         self.cropRect.rotate(value)
 
@@ -148,26 +196,22 @@ class ImageCrop(QWidget):
         self.update()
 
     def fixCropOverflow(self):
-        while True:
-            cropDistanceFromEdge = {self.cropRect.moveBoundingLeftSide: 0 - self.cropRect.boundingRect().x(),
-                                    self.cropRect.moveBoundingTopSide: 0 - self.cropRect.boundingRect().y(),
-                                    self.cropRect.moveBoundingRightSide: self.cropRect.boundingRect().x() + self.cropRect.boundingRect().width() - self.image.width(),
-                                    self.cropRect.moveBoundingBottomSide: self.cropRect.boundingRect().y() + self.cropRect.boundingRect().height() - self.image.height()}
-            if max(cropDistanceFromEdge.values()) > 0:
-                max(cropDistanceFromEdge, key=cropDistanceFromEdge.get)(cropDistanceFromEdge[max(cropDistanceFromEdge, key=cropDistanceFromEdge.get)])
-            else:
-                break
+        self.cropRect.fitInside(self.imageWidth(), self.imageHeight())
 
     def paintEvent(self, event: QPaintEvent):
         painter = QPainter(self)
 
-        scaledImageWidth = self.image.width() / self.cropRect.width() * self.scaledCropRect().width()
-        scaledImageHeight = self.image.height() / self.cropRect.height() * self.scaledCropRect().height()
-        image = self.image.scaled(scaledImageWidth, scaledImageHeight)
-        self.scaledImgSize = image.size()
-
-        cropCenter = QPoint((scaledImageWidth * self.cropRect.center().x() / self.image.width()),
-                            (scaledImageHeight * self.cropRect.center().y() / self.image.height()))
+        # The image is never rescaled here, the painter transform samples it from the cached pyramid level closest
+        # to the display size, so dragging the crop frame only repaints. The image stays as decoded, turns and flips
+        # are part of the same transform
+        scaledImageWidth = self.imageWidth() / self.cropRect.width() * self.scaledCropRect().width()
+        scaledImageHeight = self.imageHeight() / self.cropRect.height() * self.scaledCropRect().height()
+        scale = scaledImageWidth / self.imageWidth()
+        image = self.pyramid.level(self.image, round(self.sourceSize.height() * scale))
+        self.scaledImgSize = QSize(round(scaledImageWidth), round(scaledImageHeight))
+
+        cropCenter = QPointF(scaledImageWidth * self.cropRect.center()[0] / self.imageWidth(),
+                             scaledImageHeight * self.cropRect.center()[1] / self.imageHeight())
         pen = QPen()
         pen.setWidth(0)
         painter.setPen(pen)
@@ -182,7 +226,13 @@ class ImageCrop(QWidget):
         painter.translate(self.size().width() / 2, self.size().height() / 2)
         painter.rotate(-self.cropRect.rotation)
 
-        painter.drawImage(-cropCenter.x(), -cropCenter.y(), image)
+        painter.save()
+        painter.translate(-cropCenter.x(), -cropCenter.y())
+        painter.scale(scale, scaledImageHeight / self.imageHeight())
+        painter.setTransform(self.orientation.transform(self.sourceSize.width(), self.sourceSize.height()), True)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(QRectF(0, 0, self.sourceSize.width(), self.sourceSize.height()), image)
+        painter.restore()
 
         painter.rotate(self.cropRect.rotation)
         painter.translate(-(self.size().width() / 2), -(self.size().height() / 2))
@@ -214,17 +264,15 @@ class ImageCrop(QWidget):
             cropWidth = self.cropRect.width()
             cropHeight = cropWidth * cropSizeRatio
 
-            pointF = self.cropRect.verMovementVector*(self.cropRect.height()/2 - cropHeight/2)
-            startingPoint = self.cropRect.polygon[0] + pointF.toPoint()
+            startingPoint = self.cropRect.points[0] + self.cropRect.verMovementVector*(self.cropRect.height()/2 - cropHeight/2)
         else:
             cropHeight = self.cropRect.height()
             cropWidth = cropHeight / cropSizeRatio
 
-            pointF = self.cropRect.horMovementVector * (self.cropRect.width()/2 - cropWidth/2)
-            startingPoint = self.cropRect.polygon[0] + pointF.toPoint()
+            startingPoint = self.cropRect.points[0] + self.cropRect.horMovementVector * (self.cropRect.width()/2 - cropWidth/2)
 
 
-        self.cropRect = CropRectangle(startingPoint.x(), startingPoint.y(), cropWidth, cropHeight, self.cropRect.rotation)
+        self.cropRect = CropRectangle(startingPoint[0], startingPoint[1], cropWidth, cropHeight, self.cropRect.rotation)
         self.update()
 
     def drawCropFrame(self, painter):
@@ -349,43 +397,44 @@ class ImageCrop(QWidget):
             self.setCursor(cursor)
 
         if self.mousePressed:
-            xScale = self.image.width() / self.scaledImgSize.width()
-            yScale = self.image.height() / self.scaledImgSize.height()
+            xScale = self.imageWidth() / self.scaledImgSize.width()
+            yScale = self.imageHeight() / self.scaledImgSize.height()
 
             xMovement = (event.x() - self.prevX) * xScale
             yMovement = (event.y() - self.prevY) * yScale
 
             minimumSize = 70
             if self.selectedhandle == "DragHandle":
-                translatedRect = self.cropRect.polygon.translated(xMovement, yMovement)
-                if xMovement < 0 <= translatedRect.boundingRect().x():
-                    self.cropRect.polygon.translate(xMovement, 0)
-                if xMovement > 0 and translatedRect.boundingRect().x() + translatedRect.boundingRect().width() < self.image.width():
-                    self.cropRect.polygon.translate(xMovement, 0)
-                if yMovement < 0 < translatedRect.boundingRect().y():
-                    self.cropRect.polygon.translate(0, yMovement)
-                if yMovement > 0 and translatedRect.boundingRect().y() + translatedRect.boundingRect().height()  < self.image.height():
-                    self.cropRect.polygon.translate(0, yMovement)
+                left, top, right, bottom = self.cropRect.bounds()
+                if xMovement < 0 <= left + xMovement:
+                    self.cropRect.translate(xMovement, 0)
+                if xMovement > 0 and right + xMovement < self.imageWidth():
+                    self.cropRect.translate(xMovement, 0)
+                if yMovement < 0 < top + yMovement:
+                    self.cropRect.translate(0, yMovement)
+                if yMovement > 0 and bottom + yMovement < self.imageHeight():
+                    self.cropRect.translate(0, yMovement)
 
-            leftBounding = self.cropRect.boundingRect().x() + 5
-            topBounding = self.cropRect.boundingRect().y() + 5
-            rightBounding = self.cropRect.boundingRect().x() + self.cropRect.boundingRect().width() - 10
-            bottomBounding = self.cropRect.boundingRect().y() + self.cropRect.boundingRect().height() - 10
+            left, top, right, bottom = self.cropRect.bounds()
+            leftBounding = left + 5
+            topBounding = top + 5
+            rightBounding = right - 10
+            bottomBounding = bottom - 10
 
 
-            xHorBoundingMov = abs(self.cropRect.horMovementVector.x() / 1) * xMovement
-            yHorBoundingMov = abs(self.cropRect.horMovementVector.y() / 1) * xMovement
-            y2HorBoundingMov = abs(self.cropRect.horMovementVector.y() / 1) * xMovement
+            xHorBoundingMov = abs(self.cropRect.horMovementVector[0]) * xMovement
+            yHorBoundingMov = abs(self.cropRect.horMovementVector[1]) * xMovement
+            y2HorBoundingMov = abs(self.cropRect.horMovementVector[1]) * xMovement
 
-            yVerBoundingMov = abs(self.cropRect.verMovementVector.y() / 1) * yMovement
-            xVerBoundingMov = abs(self.cropRect.verMovementVector.x() / 1) * yMovement
-            x2VerBoundingMov = abs(self.cropRect.verMovementVector.x() / 1) * yMovement
+            yVerBoundingMov = abs(self.cropRect.verMovementVector[1]) * yMovement
+            xVerBoundingMov = abs(self.cropRect.verMovementVector[0]) * yMovement
+            x2VerBoundingMov = abs(self.cropRect.verMovementVector[0]) * yMovement
 
 
             diagonalMove = False
             if "Left" in self.selectedhandle:
                 if self.scaledCropRect().width() - (event.x() - self.prevX) > self.xHandlesLength and self.cropRect.width() - xMovement > minimumSize:
-                    if (leftBounding + xHorBoundingMov >= 0 and topBounding + yHorBoundingMov >= 0 and bottomBounding - y2HorBoundingMov <= self.image.height()) or xMovement > 0:
+                    if (leftBounding + xHorBoundingMov >= 0 and topBounding + yHorBoundingMov >= 0 and bottomBounding - y2HorBoundingMov <= self.imageHeight()) or xMovement > 0:
                         if not "Middle" in self.selectedhandle and self.shiftHeld:
                             movement = math.sqrt(xMovement**2 + yMovement**2) * (1 if xMovement+yMovement > 0 else -1)
                             self.cropRect.moveLeftSide(movement)
@@ -396,7 +445,7 @@ class ImageCrop(QWidget):
 
             if "Right" in self.selectedhandle:
                 if self.scaledCropRect().width() + (event.x() - self.prevX) > self.xHandlesLength and self.cropRect.width() + xMovement > minimumSize:
-                    if (rightBounding + xHorBoundingMov <= self.image.width() and topBounding - yHorBoundingMov >= 0 and bottomBounding + y2HorBoundingMov <= self.image.height()) or xMovement < 0:
+                    if (rightBounding + xHorBoundingMov <= self.imageWidth() and topBounding - yHorBoundingMov >= 0 and bottomBounding + y2HorBoundingMov <= self.imageHeight()) or xMovement < 0:
                         if not "Middle" in self.selectedhandle and self.shiftHeld:
                             movement = math.sqrt(xMovement ** 2 + yMovement ** 2) * (1 if xMovement+yMovement > 0 else -1)
                             self.cropRect.moveRightSide(movement)
@@ -406,7 +455,7 @@ class ImageCrop(QWidget):
 
             if "Bottom" in self.selectedhandle:
                 if self.scaledCropRect().height() + (event.y() - self.prevY) > self.yHandleLength and self.cropRect.height() + yMovement > minimumSize:
-                    if (bottomBounding + yVerBoundingMov <= self.image.height() and leftBounding - xVerBoundingMov >= 0 and rightBounding + x2VerBoundingMov <= self.image.width()) or yMovement < 0:
+                    if (bottomBounding + yVerBoundingMov <= self.imageHeight() and leftBounding - xVerBoundingMov >= 0 and rightBounding + x2VerBoundingMov <= self.imageWidth()) or yMovement < 0:
                         if not "Middle" in self.selectedhandle and self.shiftHeld and diagonalMove:
                             movement = math.sqrt(xMovement**2 + yMovement**2) * self.cropRect.height()/self.cropRect.width() * (1 if xMovement+yMovement > 0 else -1)
                             self.cropRect.moveBottomSide(movement)
@@ -415,7 +464,7 @@ class ImageCrop(QWidget):
 
             if "Top" in self.selectedhandle:
                 if self.scaledCropRect().height() - (event.y() - self.prevY) > self.yHandleLength and self.cropRect.height() - yMovement > minimumSize:
-                    if (topBounding + yVerBoundingMov >= 0 and leftBounding + xVerBoundingMov >= 0 and rightBounding - x2VerBoundingMov <= self.image.width()) or yMovement > 0:
+                    if (topBounding + yVerBoundingMov >= 0 and leftBounding + xVerBoundingMov >= 0 and rightBounding - x2VerBoundingMov <= self.imageWidth()) or yMovement > 0:
                         if not "Middle" in self.selectedhandle and self.shiftHeld and diagonalMove:
                             movement = math.sqrt(xMovement ** 2 + yMovement ** 2) * self.cropRect.height() / self.cropRect.width() * (1 if xMovement+yMovement > 0 else -1)
                             self.cropRect.moveTopSide(movement)
@@ -471,16 +520,9 @@ class ImageCrop(QWidget):
         if event.key() == Qt.Key_Shift:
             self.shiftHeld = False
 
-    def cropedImage(self):
-        canvas = QPixmap(int(self.cropRect.width()), int(self.cropRect.height()))
-        canvas.fill(Qt.white)
-        painter = QPainter(canvas)
-
-        painter.translate(self.cropRect.width() / 2, self.cropRect.height() / 2)
-        painter.rotate(-self.cropRect.rotation)
-        painter.drawImage(-self.cropRect.center().x(), -self.cropRect.center().y(), self.image)
-        painter.end()
-        return canvas.toImage()
+    def cropGeometry(self):
+        centerX, centerY = self.cropRect.center()
+        return float(centerX), float(centerY), self.cropRect.width(), self.cropRect.height(), self.cropRect.rotation
 
 
 class Slider(QSlider):
@@ -492,60 +534,53 @@ class Slider(QSlider):
         self.valueChanged.connect(self.setPreviousValue)
 
     def setPreviousValue(self):
-        self.mainWindow.changesSaved = False
+        self.mainWindow.markChanged()
         self.previousValue = self.currentValue
         self.currentValue = self.value()
 
 
 class CropRectangle:
-    def __init__(self, x, y, width, height, rotation=None):
-        if rotation == None:
-            self.polygon = QPolygon([QPoint(x, y), QPoint(width, y),
-                                     QPoint(x, height), QPoint(width, height)])
-            self.horMovementVector = QPointF(1, 0)
-            self.verMovementVector = QPointF(0, 1)
-            self.rotation = 0
-        else:
-            self.rotation = rotation
-            transform = QTransform()
-            transform.rotate(self.rotation)
-
-            self.horMovementVector = transform.map(QPointF(1, 0))
-            self.verMovementVector = transform.map(QPointF(0, 1))
-
-            self.polygon = QPolygon([QPoint(x, y), QPoint(x, y)+(self.horMovementVector*width).toPoint(),
-                                     QPoint(x, y)+(self.verMovementVector*height).toPoint(), QPoint(x, y)+(self.horMovementVector*width).toPoint() + (self.verMovementVector*height).toPoint()])
+    # The corners are a 4x2 float array ordered top left, top right, bottom left, bottom right in the crop's own
+    # frame. Floats keep rotations and moves from accumulating rounding, the derived sizes are cached per change
+    __slots__ = ("points", "rotation", "horMovementVector", "verMovementVector", "cache")
+
+    def __init__(self, x, y, width, height, rotation=0):
+        self.rotation = rotation
+        self.horMovementVector, self.verMovementVector = rotationMatrix(rotation)
+        origin = np.array([x, y], dtype=float)
+        self.points = np.array([origin, origin + self.horMovementVector * width, origin + self.verMovementVector * height,
+                                origin + self.horMovementVector * width + self.verMovementVector * height])
+        self.cache = None
+
+    def derived(self):
+        if self.cache is None:
+            width = math.hypot(*(self.points[1] - self.points[0]))
+            height = math.hypot(*(self.points[2] - self.points[0]))
+            left, top = self.points.min(axis=0)
+            right, bottom = self.points.max(axis=0)
+            self.cache = width, height, self.points.mean(axis=0), (left, top, right, bottom)
+        return self.cache
 
     def width(self):
-        width = math.sqrt((self.polygon.at(0).x() - self.polygon.at(1).x()) ** 2 +
-                          (self.polygon.at(0).y() - self.polygon.at(1).y()) ** 2)
-        return width
+        return self.derived()[0]
 
     def height(self):
-        height = math.sqrt((self.polygon.at(0).x() - self.polygon.at(2).x()) ** 2 +
-                           (self.polygon.at(0).y() - self.polygon.at(2).y()) ** 2)
-        return height
+        return self.derived()[1]
 
     def pivotLeft(self, width):
-        point0 = QPoint(self.polygon[1].y(), width-self.polygon[1].x())
-        point1 = QPoint(self.polygon[3].y(), width-self.polygon[3].x())
-        point2 = QPoint(self.polygon[0].y(), width-self.polygon[0].x())
-        point3 = QPoint(self.polygon[2].y(), width-self.polygon[2].x())
-        self.polygon = QPolygon([point0, point1, point2, point3])
+        # Quarter turn of the image, (x, y) becomes (y, width - x) and the corners are renamed to match
+        self.points = (self.points @ np.array([[0, -1], [1, 0]]) + (0, width))[[1, 3, 0, 2]]
+        self.cache = None
 
     def pivotRight(self, height):
-        point0 = QPoint(height-self.polygon[2].y(), self.polygon[2].x())
-        point1 = QPoint(height-self.polygon[0].y(), self.polygon[0].x())
-        point2 = QPoint(height-self.polygon[3].y(), self.polygon[3].x())
-        point3 = QPoint(height-self.polygon[1].y(), self.polygon[1].x())
-        print(self.polygon,"\n", QPolygon([point0, point1, point2, point3]))
-        self.polygon = QPolygon([point0, point1, point2, point3])
+        # (x, y) becomes (height - y, x)
+        self.points = (self.points @ np.array([[0, 1], [-1, 0]]) + (height, 0))[[2, 0, 3, 1]]
+        self.cache = None
 
     def moveLeftSide(self, pixel, keepAspectRatio=False):
         if not keepAspectRatio:
-            movement = self.horMovementVector * pixel
-            self.polygon[0] += movement.toPoint()
-            self.polygon[2] += movement.toPoint()
+            self.points[[0, 2]] += self.horMovementVector * pixel
+            self.cache = None
         else:
             widthUnit = 1
             heightUnit = self.height() / self.width()
@@ -558,9 +593,8 @@ class CropRectangle:
 
     def moveRightSide(self, pixel, keepAspectRatio=False):
         if not keepAspectRatio:
-            movement = self.horMovementVector * pixel
-            self.polygon[1] += movement.toPoint()
-            self.polygon[3] += movement.toPoint()
+            self.points[[1, 3]] += self.horMovementVector * pixel
+            self.cache = None
         else:
             widthUnit = 1
             heightUnit = self.height() / self.width()
@@ -573,9 +607,8 @@ class CropRectangle:
 
     def moveTopSide(self, pixel, keepAspectRatio=False):
         if not keepAspectRatio:
-            movement = self.verMovementVector * pixel
-            self.polygon[0] += movement.toPoint()
-            self.polygon[1] += movement.toPoint()
+            self.points[[0, 1]] += self.verMovementVector * pixel
+            self.cache = None
         else:
             heightUnit = 1
             widthUnit = self.width() / self.height()
@@ -588,9 +621,8 @@ class CropRectangle:
 
     def moveBottomSide(self, pixel, keepAspectRatio=False):
         if not keepAspectRatio:
-            movement = self.verMovementVector * pixel
-            self.polygon[2] += movement.toPoint()
-            self.polygon[3] += movement.toPoint()
+            self.points[[2, 3]] += self.verMovementVector * pixel
+            self.cache = None
         else:
             heightUnit = 1
             widthUnit = self.width() / self.height()
@@ -601,90 +633,49 @@ class CropRectangle:
             self.moveLeftSide(-widthPixelMove)
             self.moveRightSide(widthPixelMove)
 
-    def _setBoundingRect(self, newRect):
-        newRectAspectRatio = newRect.width() / newRect.height()
-        currentBoundingAspectRatio = self.boundingRect().width() / self.boundingRect().height()
-        if int(newRectAspectRatio) == int(currentBoundingAspectRatio):
-            newPolygon = QPolygon()
-            for point in self.polygon.toList():
-                newX = newRect.width() * (
-                            point.x() - self.boundingRect().x()) / self.boundingRect().width() + newRect.x()
-                newY = newRect.height() * (
-                            point.y() - self.boundingRect().y()) / self.boundingRect().height() + newRect.y()
-                newPolygon.append(QPoint(newX, newY))
-            self.polygon = newPolygon
-        else:
-            raise Exception("Aspect Ratio not kept")
-
-    def moveBoundingLeftSide(self, pixel):
-        resizedRect = self.polygon.boundingRect()
-        widthUnit = 1
-        heightUnit = resizedRect.height() / resizedRect.width()
-        widthPixelMove = pixel * widthUnit
-        heightPixelMove = pixel / 2 * heightUnit
-
-        resizedRect.setX(resizedRect.x() + widthPixelMove)
-        resizedRect.setY(resizedRect.y() + heightPixelMove)
-        resizedRect.setHeight(resizedRect.height() - heightPixelMove)
-
-        self._setBoundingRect(resizedRect)
-
-    def moveBoundingTopSide(self, pixel):
-        resizedRect = self.polygon.boundingRect()
-        heightUnit = 1
-        widthUnit = resizedRect.width() / resizedRect.height()
-        heightPixelMove = pixel * heightUnit
-        widthPixelMove = pixel / 2 * widthUnit
-
-        resizedRect.setY(resizedRect.y() + heightPixelMove)
-        resizedRect.setX(resizedRect.x() + widthPixelMove)
-        resizedRect.setWidth(resizedRect.width() - widthPixelMove)
-
-        self._setBoundingRect(resizedRect)
-
-    def moveBoundingBottomSide(self, pixel):
-        resizedRect = self.polygon.boundingRect()
-        heightUnit = 1
-        widthUnit = resizedRect.width() / resizedRect.height()
-        heightPixelMove = pixel * heightUnit
-        widthPixelMove = pixel / 2 * widthUnit
+    def fitInside(self, width, height):
+        # Scaling about the center scales the bounding box by the same factor, so the largest scale that fits the
+        # image follows from the bounding box directly. For a w x h crop rotated by a that box is
+        # w|cos a| + h|sin a| by w|sin a| + h|cos a|. Whatever still overflows after scaling is shifted back inside
+        left, top, right, bottom = self.bounds()
+        if left >= 0 and top >= 0 and right <= width and bottom <= height:
+            return
+        scale = min(1, width / (right - left), height / (bottom - top))
 
-        resizedRect.setHeight(resizedRect.height() - heightPixelMove)
-        resizedRect.setX(resizedRect.x() + widthPixelMove)
-        resizedRect.setWidth(resizedRect.width() - widthPixelMove)
+        center = self.center()
+        points = (self.points - center) * scale + center
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
+        points += (max(0, -left) - max(0, right - width), max(0, -top) - max(0, bottom - height))
+        self.points = points
+        self.cache = None
 
-        self._setBoundingRect(resizedRect)
+    def rotate(self, degree):
+        self.rotation += degree
+        matrix = rotationMatrix(degree)
+        center = self.center()
+        self.points = (self.points - center) @ matrix + center
+        self.horMovementVector = self.horMovementVector @ matrix
+        self.verMovementVector = self.verMovementVector @ matrix
+        self.cache = None
 
-    def moveBoundingRightSide(self, pixel):
-        resizedRect = self.polygon.boundingRect()
-        widthUnit = 1
-        heightUnit = resizedRect.height() / resizedRect.width()
-        widthPixelMove = pixel * widthUnit
-        heightPixelMove = pixel / 2 * heightUnit
+    def translate(self, x, y):
+        self.points += (x, y)
+        self.cache = None
 
-        resizedRect.setWidth(resizedRect.width() - widthPixelMove)
-        resizedRect.setY(resizedRect.y() + heightPixelMove)
-        resizedRect.setHeight(resizedRect.height() - heightPixelMove)
+    def scale(self, factor):
+        self.points *= factor
+        self.cache = None
 
-        self._setBoundingRect(resizedRect)
+    def center(self):
+        return self.derived()[2]
 
-    def rotate(self, degree):
-        self.rotation += degree
-        centerPoint = self.center()
-        originCenteredPolygon = self.polygon.translated(-centerPoint.x(), -centerPoint.y())
-        transform = QTransform()
-        transform.rotate(degree)
-        rotatedPolygon = transform.map(originCenteredPolygon)
-        rotatedPolygon.translate(centerPoint.x(), centerPoint.y())
-        self.horMovementVector = transform.map(self.horMovementVector)
-        self.verMovementVector = transform.map(self.verMovementVector)
-        self.polygon = rotatedPolygon
+    def bounds(self):
+        return self.derived()[3]
 
-    def center(self):
-        centerPoint = QPoint(
-            (self.polygon.at(0).x() + self.polygon.at(1).x() + self.polygon.at(2).x() + self.polygon.at(3).x()) / 4,
-            (self.polygon.at(0).y() + self.polygon.at(1).y() + self.polygon.at(2).y() + self.polygon.at(3).y()) / 4)
-        return centerPoint
 
-    def boundingRect(self):
-        return self.polygon.boundingRect()
+def rotationMatrix(degree):
+    # Rows are where the x and y unit vectors go, the same rotation QTransform.rotate applies, so a row vector
+    # times the matrix is rotated by degree
+    angle = math.radians(degree)
+    return np.array([[math.cos(angle), math.sin(angle)], [-math.sin(angle), math.cos(angle)]])
@@ -0,0 +1,172 @@
+import os
+import stat
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from PySide6.QtCore import QObject, Signal
+
+from ExportPresets import downscale
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def formatForPath(path):
+    extension = os.path.splitext(path)[1].lower()
+    imageFormat = Image.registered_extensions().get(extension)
+    if imageFormat is None:
+        raise ValueError("unsupported image format " + extension)
+    return imageFormat
+
+
+def temporaryFile(directory, name):
+    # Like mkstemp, but created with the mode a plain open gives a new file, the kernel takes the umask off 0o666
+    while True:
+        temporaryPath = os.path.join(directory, ".{}.{}.part".format(name, uuid.uuid4().hex[:8]))
+        try:
+            return os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+                           0o666), temporaryPath
+        except FileExistsError:
+            pass
+
+
+def writeImage(image, path, options=None):
+    # The image is encoded into a temporary file next to path and renamed over it once complete, so path never
+    # holds half an image and an existing file survives a failed export
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(np.ascontiguousarray(image), "RGB")
+    directory, name = os.path.split(os.path.abspath(path))
+    descriptor, temporaryPath = temporaryFile(directory, name)
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            image.save(file, formatForPath(path), **(options or {}))
+            file.flush()
+            os.fsync(file.fileno())
+        # A file written over keeps its mode
+        try:
+            os.chmod(temporaryPath, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(temporaryPath, path)
+    except BaseException:
+        os.remove(temporaryPath)
+        raise
+
+
+class ExportJob:
+    def __init__(self, pipeline, variants):
+        # variants are (path, size, options), every one is written from the same render
+        self.pipeline = pipeline
+        self.variants = variants
+        self.cancelled = False
+        self.status = None
+        self.error = None
+        self.timings = {}
+
+    def name(self):
+        if len(self.variants) == 1:
+            return os.path.basename(self.variants[0][0])
+        return "{} files".format(len(self.variants))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def checkCancelled(self):
+        if self.cancelled:
+            raise ExportCancelled()
+
+
+class ImageExporter(QObject):
+    progressed = Signal(object, str, int, int)
+    finished = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.encoder = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.jobs = []
+
+    def export(self, pipeline, path, options=None):
+        return self.exportVariants(pipeline, [(path, None, options)])
+
+    def exportVariants(self, pipeline, variants):
+        # pipeline should be a snapshot, editing goes on while the job renders it on the worker
+        job = ExportJob(pipeline, variants)
+        with self.lock:
+            self.jobs.append(job)
+        self.executor.submit(self.run, job)
+        return job
+
+    def isBusy(self):
+        with self.lock:
+            return bool(self.jobs)
+
+    def cancel(self):
+        with self.lock:
+            for job in self.jobs:
+                job.cancel()
+
+    def run(self, job):
+        try:
+            job.checkCancelled()
+            data = self.render(job)
+            self.encode(job, data)
+            job.status = "saved"
+        except ExportCancelled:
+            job.status = "cancelled"
+        except Exception as exception:
+            print('export failed', exception)
+            job.status = "failed"
+            job.error = str(exception)
+
+        with self.lock:
+            self.jobs.remove(job)
+        self.finished.emit(job)
+
+    def render(self, job):
+        # Every pass over the tiles reports its progress under the stage it belongs to and checks for cancellation
+        # between tiles
+        pipeline = job.pipeline
+        stage = ["crop"]
+
+        def tileDone(done, total):
+            self.progressed.emit(job, stage[0], done, total)
+            job.checkCancelled()
+
+        with pipeline.tileScheduler.observe(tileDone):
+            pipeline.renderData(pipeline.renderKey(False, cropped=True))
+            stage[0] = "render"
+            return pipeline.render(cropped=True)
+
+    def encode(self, job, data):
+        # The variants are downscaled and encoded side by side, PIL lets go of the GIL for both
+        image = Image.fromarray(np.ascontiguousarray(data), "RGB")
+        self.progressed.emit(job, "encode", 0, len(job.variants))
+        futures = [self.encoder.submit(self.encodeVariant, job, image, variant) for variant in job.variants]
+        try:
+            for done, future in enumerate(futures, 1):
+                future.result()
+                self.progressed.emit(job, "encode", done, len(futures))
+        except BaseException:
+            job.cancel()
+            for future in futures:
+                future.exception()
+            raise
+
+    def encodeVariant(self, job, image, variant):
+        path, size, options = variant
+        job.checkCancelled()
+        start = time.perf_counter()
+        resized = downscale(image, size)
+        scaled = time.perf_counter()
+        writeImage(resized, path, options)
+        job.timings[path] = (scaled - start, time.perf_counter() - scaled)
+        print('exported {} {}x{} in {:.0f} ms (resize {:.0f} ms, encode {:.0f} ms)'.format(
+            os.path.basename(path), resized.width, resized.height, (time.perf_counter() - start) * 1000,
+            (scaled - start) * 1000, (time.perf_counter() - scaled) * 1000))
@@ -0,0 +1,57 @@
+import numpy as np
+from PIL import Image
+from PySide6.QtGui import QImage
+
+from ImageBridge import arrayToQImage
+from ImageStorage import ImageStorage
+from StripDecoder import decodeStrips
+from TileScheduler import TILE_PIXELS
+
+
+class ImageSource:
+    # The one decode of an image file. The pixel buffer is read only and everything that needs the unedited image
+    # gets a view of it instead of decoding the file again
+    def __init__(self, imageFile, storage=None, draftSize=None):
+        self.imageFile = imageFile
+        self.storage = storage or ImageStorage()
+        self.isDraft = False
+        self.data = self.decode(imageFile, draftSize)
+        self.data.flags.writeable = False
+        self.wrapper = None
+
+    def decode(self, imageFile, draftSize=None):
+        # PNGs and uncompressed images are decoded strip by strip straight into the buffer, so besides a memory mapped
+        # buffer only a strip is resident. Any other format is decoded whole by PIL first and only its conversion to
+        # RGB goes strip by strip. With a draft size JPEGs are decoded at the smallest DCT scale that still covers it,
+        # a fraction of the work of the full decode, the long side of the draft is at least draftSize
+        with Image.open(imageFile) as image:
+            if draftSize is not None:
+                fullSize = image.size
+                scale = draftSize / max(fullSize)
+                image.draft("RGB", (max(1, int(fullSize[0] * scale)), max(1, int(fullSize[1] * scale))))
+                self.isDraft = image.size != fullSize
+            data = self.storage.allocate((image.height, image.width, 3))
+            rows = max(1, TILE_PIXELS // image.width)
+            strips = decodeStrips(image, rows)
+            if strips is None:
+                strips = ((0, top, image.crop((0, top, image.width, min(top + rows, image.height))))
+                          for top in range(0, image.height, rows))
+            for left, top, strip in strips:
+                data[top:top + strip.height, left:left + strip.width] = np.asarray(strip.convert("RGB"))
+        return data
+
+    def width(self):
+        return self.data.shape[1]
+
+    def height(self):
+        return self.data.shape[0]
+
+    def array(self):
+        return self.data
+
+    def image(self):
+        # The source keeps its own wrapper of the buffer, so every QImage handed out shares it with at least one
+        # other reference and Qt detaches it into a copy before anything can paint into the buffer
+        if self.wrapper is None:
+            self.wrapper = arrayToQImage(self.data)
+        return QImage(self.wrapper)
@@ -0,0 +1,70 @@
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+
+DEFAULT_MEMORY_BUDGET = 2 << 30
+MEMORY_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parseMemoryBudget(text):
+    # "512M", "4G" or a number of bytes, "none" keeps every buffer in RAM
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    if text == "NONE":
+        return None
+    unit = text[-1:] if text[-1:] in MEMORY_UNITS else ""
+    try:
+        value = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError("invalid memory size " + repr(text)) from None
+    if not 0 < value < float("inf"):
+        raise ValueError("the memory budget has to be a positive size")
+    return int(value * MEMORY_UNITS[unit])
+
+
+class ImageStorage:
+    def __init__(self, memoryBudget=DEFAULT_MEMORY_BUDGET, directory=None):
+        self.memoryBudget = memoryBudget
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.residentBytes = 0
+        self.mappedBytes = 0
+        self.allocations = 0
+        self.allocatedBytes = 0
+
+    def setMemoryBudget(self, memoryBudget):
+        # Only later allocations follow the new budget, buffers already handed out stay where they are
+        with self.lock:
+            self.memoryBudget = memoryBudget
+
+    def allocate(self, shape, dtype=np.uint8):
+        # Buffers go to RAM while they fit in the budget, anything past it is backed by an unlinked scratch file
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self.lock:
+            self.allocations += 1
+            self.allocatedBytes += size
+            mapped = self.memoryBudget is not None and self.residentBytes + size > self.memoryBudget
+            if mapped:
+                self.mappedBytes += size
+            else:
+                self.residentBytes += size
+
+        if mapped:
+            with tempfile.TemporaryFile(prefix="bie-", dir=self.directory) as file:
+                buffer = np.memmap(file, dtype, "w+", shape=shape)
+            weakref.finalize(buffer, self.release, size, True)
+        else:
+            buffer = np.empty(shape, dtype)
+            weakref.finalize(buffer, self.release, size, False)
+        return buffer
+
+    def release(self, size, mapped):
+        with self.lock:
+            if mapped:
+                self.mappedBytes -= size
+            else:
+                self.residentBytes -= size
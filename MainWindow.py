@@ -1,15 +1,23 @@
-from PySide6.QtCore import QSize, Signal
-from PySide6.QtGui import Qt, QIcon, QImageReader, QActionGroup, QAction, QResizeEvent, QImage, QPixmap
+import os
+
+from PySide6.QtCore import QSize, Signal, QSettings
+from PySide6.QtGui import Qt, QIcon, QImageReader, QActionGroup, QAction, QResizeEvent, QPixmap
 from PySide6.QtWidgets import QMainWindow, QPushButton, QHBoxLayout, QWidget, QVBoxLayout, QStackedWidget, QFileDialog, \
-    QToolBar, QMessageBox
+    QToolBar, QMessageBox, QProgressDialog, QInputDialog
 
 from AboutPage import AboutPage
+from AdjustmentPipeline import PRECISIONS, defaultPrecision
 from ImageCropTab import ImageCropTab
 from ImageAdjustTab import ImageAdjustTab
+from ExportPresets import presetVariants
+from ImageExporter import ImageExporter
+from ImageStorage import DEFAULT_MEMORY_BUDGET, ImageStorage
+from SourceLoader import SourceLoader
 
 class MainWindow(QMainWindow):
     resized = Signal()
     imageChanged = Signal()
+    sourceUpgraded = Signal()
 
     def __init__(self, imagePath):
         super().__init__()
@@ -17,9 +25,23 @@ class MainWindow(QMainWindow):
         self.setWindowIcon(QIcon("icon/logo.svg"))
 
         self.imageFile = imagePath
-        self.image = QImage(self.imageFile)
-        self.modifiedImage = QImage(self.imageFile)
+        self.settings = QSettings("Bensky", "Bensky Image Editor")
+        self.storage = ImageStorage(int(self.settings.value("memoryBudget", DEFAULT_MEMORY_BUDGET)))
+        self.loader = SourceLoader()
+        self.loader.sourceReady.connect(self.upgradeSource)
+        self.loader.sourceFailed.connect(self.sourceFailed)
+        self.source = self.loader.open(self.imageFile, self.storage)
+        self.image = self.source.image()
+        self.modifiedImage = self.image
         self.changesSaved = True
+        self.revision = 0
+
+        self.exporter = ImageExporter()
+        self.exporter.progressed.connect(self.showExportProgress)
+        self.exporter.finished.connect(self.exportFinished)
+        self.exportRevisions = {}
+        self.exportProgress = None
+        self.openAfterSave = None
 
         self.setupHeaderLayout()
         self.setupToolbar()
@@ -49,6 +71,20 @@ class MainWindow(QMainWindow):
         self.saveButton.setStyleSheet("QPushButton:hover{background: #CBE7FE;} QPushButton{background: white; border: 0; padding: 8px 16px; border-bottom: 3px solid #ff5900; color: #E75801;}")
         self.saveButton.clicked.connect(self.saveImage)
 
+        self.exportButton = QPushButton(QIcon("icon/saveimage.svg"), "Export")
+        self.exportButton.setStyleSheet("QPushButton:hover{background: #CBE7FE;} QPushButton{background: white; border: 0; padding: 8px 16px; border-bottom: 3px solid #ff5900; color: #E75801;}")
+        self.exportButton.clicked.connect(self.exportPresets)
+
+        self.memoryButton = QPushButton("Memory")
+        self.memoryButton.setStyleSheet('padding: 4px 8px 4px 8px;')
+        self.memoryButton.setFlat(True)
+        self.memoryButton.clicked.connect(self.changeMemoryBudget)
+
+        self.engineButton = QPushButton("Engine")
+        self.engineButton.setStyleSheet('padding: 4px 8px 4px 8px;')
+        self.engineButton.setFlat(True)
+        self.engineButton.clicked.connect(self.changePrecision)
+
         self.helpButton = QPushButton(QIcon("icon/infoimage.svg"), "About")
         self.helpButton.clicked.connect(self.showAboutPage)
         self.helpButton.setFlat(True)
@@ -65,7 +101,10 @@ class MainWindow(QMainWindow):
         headerLayout.addStretch()
         headerLayout.addWidget(self.newButton)
         headerLayout.addWidget(self.saveButton)
+        headerLayout.addWidget(self.exportButton)
         headerLayout.addStretch()
+        headerLayout.addWidget(self.memoryButton)
+        headerLayout.addWidget(self.engineButton)
         headerLayout.addWidget(self.helpButton)
 
         self.setMenuWidget(header)
@@ -112,6 +151,7 @@ class MainWindow(QMainWindow):
         self.addToolBar(Qt.LeftToolBarArea, self.toolbar)
 
     def gotoCropPanel(self):
+        self.imageAdjustWidget.commitChanges()
         self.stackedWidget.setCurrentWidget(self.imageCropWidget)
         self.zoomOutAction.setVisible(False)
         self.zoomInAction.setVisible(False)
@@ -125,17 +165,22 @@ class MainWindow(QMainWindow):
         self.imageChanged.emit()
         self.modifiedImage = self.image
         self.changesSaved = True
+        self.revision += 1
         self.imageChanged.emit()
 
-
+    def markChanged(self):
+        # Exports still running when the edit changes no longer save what is being edited
+        self.changesSaved = False
+        self.revision += 1
 
     def openNewImage(self):
         if not self.changesSaved:
             response = QMessageBox.question(self, 'Changes unsaved', 'Do you want to save the current image?')
             if response == QMessageBox.Yes:
-                saved = self.saveImage()
-                if not saved:
-                    return
+                # The next image is only opened once the save has written the file, a failed or cancelled save
+                # keeps the current one
+                self.openAfterSave = self.saveImage()
+                return
 
         formats = ["*." + extension.data().decode() for extension in QImageReader.supportedImageFormats()]
         fileFilter = "Images (" + " ".join(formats) + ")"
@@ -144,19 +189,130 @@ class MainWindow(QMainWindow):
         if imagePath[0]:
             self.imageChanged.emit()
             self.imageFile = imagePath[0]
-            self.image = QImage(self.imageFile)
-            self.modifiedImage = QImage(self.imageFile)
+            self.source = self.loader.open(self.imageFile, self.storage)
+            self.image = self.source.image()
+            self.modifiedImage = self.image
             self.changesSaved = True
+            self.revision += 1
+            self.saveButton.setEnabled(True)
+            self.exportButton.setEnabled(True)
             self.imageChanged.emit()
 
 
+    def upgradeSource(self, draft, source):
+        # The full decode takes over from the draft it was started for, the crop and adjustments made against the
+        # draft carry over
+        if draft is not self.source or source is None:
+            return
+        unedited = self.modifiedImage is self.image
+        self.source = source
+        self.image = source.image()
+        if unedited:
+            self.modifiedImage = self.image
+        self.sourceUpgraded.emit()
+
+    def sourceFailed(self, draft, error):
+        # Saving the draft would write a reduced copy of the image, so nothing can be saved until another image is
+        # opened
+        if draft is not self.source:
+            return
+        self.saveButton.setEnabled(False)
+        self.exportButton.setEnabled(False)
+        QMessageBox.warning(self, 'Open failed', 'Only a preview of the image could be decoded, it cannot be saved: {}'
+                            .format(error))
+
+    def finishLoading(self):
+        if self.source.isDraft:
+            self.upgradeSource(self.source, self.loader.wait())
+        return not self.source.isDraft
+
+    def refuseDraft(self):
+        QMessageBox.warning(self, 'Save refused', 'Only a preview of the image could be decoded, it cannot be saved.')
+
     def saveImage(self):
         savePath = QFileDialog.getSaveFileName(self, "Save Image", "\home", "Images (*.{})".format(self.imageFile.split('.')[-1]))
         if savePath[0]:
-            self.imageCropWidget.cropedImage().save(savePath[0])
-            return True
+            # The export renders a snapshot of the edit on a worker, changesSaved is only set once the file is
+            # written and nothing was edited in the meantime
+            if not self.finishLoading():
+                self.refuseDraft()
+                return None
+            job = self.exporter.export(self.imageAdjustWidget.exportPipeline(), savePath[0])
+            self.startExport(job)
+            return job
         else:
-            return False
+            return None
+
+    def exportPresets(self):
+        # Every preset is written from one render of the edit, as stem + suffix in the chosen directory
+        directory = QFileDialog.getExistingDirectory(self, "Export Image", "\home")
+        if directory:
+            # Existing files, the opened image among them, are only replaced once confirmed
+            variants = presetVariants(directory, self.imageFile)
+            existing = [os.path.basename(path) for path, size, options in variants if os.path.exists(path)]
+            if existing:
+                response = QMessageBox.question(self, 'Files exist', 'Replace {}?'.format(", ".join(existing)))
+                if response != QMessageBox.Yes:
+                    return
+            if not self.finishLoading():
+                self.refuseDraft()
+                return
+            self.startExport(self.exporter.exportVariants(self.imageAdjustWidget.exportPipeline(), variants))
+
+    def startExport(self, job):
+        self.exportRevisions[job] = self.revision
+        self.showExportProgress(job, "render", 0, 1)
+
+    def showExportProgress(self, job, stage, done, total):
+        if job not in self.exportRevisions:
+            return
+        if self.exportProgress is None:
+            self.exportProgress = QProgressDialog(self)
+            self.exportProgress.setWindowTitle("Saving")
+            self.exportProgress.setMinimumDuration(0)
+            self.exportProgress.setAutoClose(False)
+            self.exportProgress.setAutoReset(False)
+            self.exportProgress.canceled.connect(self.exporter.cancel)
+            self.exportProgress.show()
+        self.exportProgress.setLabelText("Saving {} ({})".format(job.name(), stage))
+        self.exportProgress.setMaximum(total)
+        self.exportProgress.setValue(done)
+
+    def exportFinished(self, job):
+        revision = self.exportRevisions.pop(job, None)
+        if not self.exportRevisions and self.exportProgress is not None:
+            self.exportProgress.canceled.disconnect(self.exporter.cancel)
+            self.exportProgress.close()
+            self.exportProgress = None
+        if job.status == "saved" and revision == self.revision:
+            self.changesSaved = True
+        elif job.status == "failed":
+            QMessageBox.warning(self, 'Save failed', 'The image could not be saved: {}'.format(job.error))
+        if job is self.openAfterSave:
+            self.openAfterSave = None
+            if job.status == "saved":
+                self.openNewImage()
+
+    def changeMemoryBudget(self):
+        # Image buffers past the budget are backed by scratch files instead of RAM, the choice is kept for the next
+        # start
+        budget, accepted = QInputDialog.getInt(self, "Memory Budget", "RAM for image buffers in MB:",
+                                               self.storage.memoryBudget >> 20, 256, 1 << 20, 256)
+        if accepted:
+            self.storage.setMemoryBudget(budget << 20)
+            self.settings.setValue("memoryBudget", budget << 20)
+
+    def changePrecision(self):
+        # The engine the preview renders with, saved and exported files always use EXPORT_PRECISION. The choice is
+        # kept for the next start
+        choices = ["auto"] + list(PRECISIONS)
+        current = self.settings.value("precision", "auto")
+        precision, accepted = QInputDialog.getItem(
+            self, "Adjustment Engine", "Preview engine (auto is {} here):".format(defaultPrecision()), choices,
+            choices.index(current) if current in choices else 0, False)
+        if accepted:
+            self.settings.setValue("precision", precision)
+            self.imageAdjustWidget.setPrecision(precision if precision in PRECISIONS else None)
 
     def resizeEvent(self, e:QResizeEvent):
         super().resizeEvent(e)
@@ -0,0 +1,24 @@
+from PySide6.QtGui import Qt
+
+
+class MipmapPyramid:
+    def __init__(self):
+        self.cacheKey = None
+        self.levels = []
+
+    def level(self, image, height):
+        # Halved copies of the image are built as smaller heights are asked for and dropped when the pixels
+        # change, a height is served by the smallest level that is still at least as tall
+        if image.cacheKey() != self.cacheKey:
+            self.cacheKey = image.cacheKey()
+            self.levels = [image]
+
+        index = 0
+        while self.levels[index].height() >= height * 2 and self.levels[index].height() > 1:
+            index += 1
+            if index == len(self.levels):
+                level = self.levels[-1]
+                self.levels.append(level.scaled(max(1, level.width() // 2), max(1, level.height() // 2),
+                                                Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+
+        return self.levels[index]
@@ -0,0 +1,50 @@
+import numpy as np
+from PySide6.QtGui import QTransform
+
+
+class Orientation:
+    # One of the eight rotations and flips of the image, kept as the image being mirrored left to right when flipped
+    # and then turned counterclockwise by a number of quarter turns, the order np.rot90(np.fliplr(data), turns) uses
+    __slots__ = ("turns", "flipped")
+
+    def __init__(self, turns=0, flipped=False):
+        self.turns = turns % 4
+        self.flipped = flipped
+
+    def __eq__(self, other):
+        return isinstance(other, Orientation) and (self.turns, self.flipped) == (other.turns, other.flipped)
+
+    def __hash__(self):
+        return hash((self.turns, self.flipped))
+
+    def isIdentity(self):
+        return not self.turns and not self.flipped
+
+    def rotate(self, turns):
+        return Orientation(self.turns + turns, self.flipped)
+
+    def flip(self, axis):
+        # Mirroring after the turns is the same as mirroring first and turning the other way, a vertical mirror is
+        # a horizontal one followed by half a turn
+        return Orientation((2 if axis == 0 else 0) - self.turns, not self.flipped)
+
+    def size(self, width, height):
+        return (height, width) if self.turns % 2 else (width, height)
+
+    def view(self, data):
+        return np.rot90(data[:, ::-1] if self.flipped else data, self.turns)
+
+    def matrix(self, width, height):
+        # Maps source coordinates to oriented coordinates, width and height are the size of the source
+        matrix = np.identity(3)
+        if self.flipped:
+            matrix = np.array([[-1, 0, width], [0, 1, 0], [0, 0, 1]]) @ matrix
+        for turn in range(self.turns):
+            # A quarter turn to the left takes (x, y) to (y, width - x) and swaps the sides
+            matrix = np.array([[0, 1, 0], [-1, 0, width], [0, 0, 1]]) @ matrix
+            width, height = height, width
+        return matrix
+
+    def transform(self, width, height):
+        matrix = self.matrix(width, height)
+        return QTransform(matrix[0, 0], matrix[1, 0], matrix[0, 1], matrix[1, 1], matrix[0, 2], matrix[1, 2])
@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+
+
+class RenderScheduler(QObject):
+    frameReady = Signal(object)
+
+    def __init__(self, render):
+        super().__init__()
+        self.render = render
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.pendingRequest = None
+        self.running = False
+        self.requestCount = 0
+        self.renderedFrames = 0
+        self.droppedFrames = 0
+
+    def submit(self, request):
+        # Only the newest request waits for the worker, anything it replaces is dropped without being rendered
+        with self.lock:
+            self.requestCount += 1
+            if self.pendingRequest is not None:
+                self.droppedFrames += 1
+            self.pendingRequest = request
+            if self.running:
+                return
+            self.running = True
+        self.executor.submit(self.run)
+
+    def run(self):
+        while True:
+            with self.lock:
+                request = self.pendingRequest
+                self.pendingRequest = None
+                if request is None:
+                    self.running = False
+                    return
+
+            try:
+                frame = self.render(request)
+            except Exception as exception:
+                print('render failed', exception)
+                continue
+
+            with self.lock:
+                self.renderedFrames += 1
+            self.frameReady.emit(frame)
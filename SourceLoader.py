@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+
+from ImageSource import ImageSource
+
+
+DRAFT_SIZE = 1024
+
+
+class SourceLoader(QObject):
+    sourceReady = Signal(object, object)
+    sourceFailed = Signal(object, str)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def open(self, imageFile, storage):
+        # The draft is decoded right away so the image can be shown and edited, the full decode runs on the worker
+        # and is handed back through sourceReady together with the draft it replaces, or sourceFailed reports why it
+        # could not be decoded
+        source = ImageSource(imageFile, storage, DRAFT_SIZE)
+        self.future = self.executor.submit(self.load, source, storage) if source.isDraft else None
+        return source
+
+    def load(self, draft, storage):
+        try:
+            source = ImageSource(draft.imageFile, storage)
+        except Exception as exception:
+            print('decode failed', exception)
+            self.sourceFailed.emit(draft, str(exception))
+            return None
+        self.sourceReady.emit(draft, source)
+        return source
+
+    def wait(self):
+        if self.future is None:
+            return None
+        return self.future.result()
@@ -0,0 +1,105 @@
+import struct
+import zlib
+
+from PIL import Image
+
+
+def decodeStrips(image, rows):
+    # Decodes an opened image rows at a time as (left, top, strip) in the mode of the image, so no more than a strip
+    # of the raster is ever held decoded. Non interlaced PNGs and uncompressed images (TIFF, BMP, PPM) are read that
+    # way, None for any other image, which PIL only decodes whole
+    tiles = image.tile
+    if image.format == "PNG" and len(tiles) == 1 and tiles[0][0] == "zip" and not image.info.get("interlace"):
+        bits = packedBits(image.mode, tiles[0][3])
+        if bits is not None:
+            return pngStrips(image, bits, rows)
+    elif tiles and all(tile[0] == "raw" for tile in tiles) and len({tile[1] for tile in tiles}) == len(tiles):
+        # Planar TIFFs list one tile per channel over the same extents, those are left to PIL
+        if all(packedBits(image.mode, rawArgs(tile[3])[0]) is not None for tile in tiles):
+            return rawStrips(image, rows)
+    return None
+
+
+def packedBits(mode, rawmode):
+    # Bits per pixel of rawmode, None when PIL cannot pack mode back into it
+    try:
+        return len(Image.new(mode, (8, 1)).tobytes("raw", rawmode))
+    except ValueError:
+        return None
+
+
+def rawArgs(args):
+    # The raw decoder takes a rawmode with an optional stride and row step
+    args = args if isinstance(args, tuple) else (args,)
+    return args[0], args[1] if len(args) > 1 else 0, args[2] if len(args) > 2 else 1
+
+
+def stripImage(image, size, data, decoder, *args):
+    strip = Image.frombytes(image.mode, size, data, decoder, *args)
+    if image.palette is not None:
+        strip.putpalette(image.palette.palette, image.palette.rawmode or image.palette.mode)
+    return strip
+
+
+def pngData(file, offset):
+    # The compressed stream of a PNG spans every IDAT chunk from offset on, it is read in blocks
+    file.seek(offset - 8)
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack(">I4s", header)
+        if kind != b"IDAT":
+            return
+        while length:
+            block = file.read(min(length, 1 << 16))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+        file.read(4)
+
+
+def pngStrips(image, bits, rows):
+    # The filtered rows are inflated a strip at a time and handed to PIL's PNG decoder rewrapped as stored zlib data.
+    # Every strip after the first starts with the last row of the one before, unfiltered, as the row the filters of
+    # its own first row refer to
+    width, height = image.size
+    name, extents, offset, rawmode = image.tile[0]
+    rowBytes = (width * bits + 7) // 8 + 1
+    inflater = zlib.decompressobj()
+    blocks = pngData(image.fp, offset)
+    previous = b""
+    for top in range(0, height, rows):
+        count = min(rows, height - top)
+        size = count * rowBytes
+        parts = [previous]
+        while size:
+            block = inflater.unconsumed_tail or next(blocks, b"")
+            data = inflater.decompress(block, size)
+            if not data and not block:
+                raise OSError("image file is truncated")
+            parts.append(data)
+            size -= len(data)
+
+        extra = 1 if previous else 0
+        strip = stripImage(image, (width, count + extra), zlib.compress(b"".join(parts), 0), "zip", rawmode)
+        last = count + extra - 1
+        previous = b"\0" + strip.crop((0, last, width, last + 1)).tobytes("raw", rawmode)
+        yield 0, top, strip.crop((0, extra, width, count + extra)) if extra else strip
+
+
+def rawStrips(image, rows):
+    # Uncompressed tiles are read straight from the file a band of rows at a time, bottom up ones (BMP) from their
+    # end
+    for name, (left, top, right, bottom), offset, args in image.tile:
+        rawmode, stride, step = rawArgs(args)
+        width, height = right - left, bottom - top
+        stride = stride or (width * packedBits(image.mode, rawmode) + 7) // 8
+        for first in range(0, height, rows):
+            count = min(rows, height - first)
+            image.fp.seek(offset + (first if step > 0 else height - first - count) * stride)
+            data = image.fp.read(count * stride)
+            if len(data) < count * stride:
+                raise OSError("image file is truncated")
+            yield left, top + first, stripImage(image, (width, count), data, "raw", rawmode, stride, step)
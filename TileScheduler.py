@@ -0,0 +1,77 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+
+TILE_PIXELS = 1 << 17
+
+
+class TileScheduler:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.local = threading.local()
+        self.scratchAllocations = 0
+
+    def tileRows(self, width):
+        return max(1, TILE_PIXELS // max(1, width))
+
+    def tiles(self, height, width):
+        rows = self.tileRows(width)
+        return [(y, min(y + rows, height)) for y in range(0, height, rows)]
+
+    def run(self, height, width, renderTile):
+        tiles = self.tiles(height, width)
+        observer = getattr(self.local, "observer", None)
+        if observer is not None:
+            renderTile = self.observed(renderTile, len(tiles), observer)
+        if self.workers == 1 or len(tiles) == 1:
+            for top, bottom in tiles:
+                renderTile(top, bottom)
+            return
+
+        futures = [self.executor.submit(renderTile, top, bottom) for top, bottom in tiles]
+        for future in futures:
+            future.result()
+
+    @contextmanager
+    def observe(self, observer):
+        # Every run started from this thread inside the block reports observer(done, total) after each tile. An
+        # exception raised by the observer stops the run, the tiles that have not started yet are skipped
+        self.local.observer = observer
+        try:
+            yield
+        finally:
+            self.local.observer = None
+
+    def observed(self, renderTile, total, observer):
+        lock = threading.Lock()
+        state = {"done": 0, "stopped": False}
+
+        def renderObservedTile(top, bottom):
+            if state["stopped"]:
+                return
+            renderTile(top, bottom)
+            with lock:
+                state["done"] += 1
+                done = state["done"]
+            try:
+                observer(done, total)
+            except Exception:
+                state["stopped"] = True
+                raise
+        return renderObservedTile
+
+    def scratch(self, name, shape, dtype):
+        # Every thread keeps its own scratch buffers, they only grow when a wider tile comes through
+        buffers = self.local.__dict__.setdefault("buffers", {})
+        size = int(np.prod(shape))
+        buffer = buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = np.empty(size, dtype)
+            buffers[name] = buffer
+            self.scratchAllocations += 1
+        return buffer[:size].reshape(shape)
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+
+from BatchProcessor import loadRecipe, runBatch
+from ImageStorage import DEFAULT_MEMORY_BUDGET, parseMemoryBudget
+
+
+def memoryBudget(text):
+    try:
+        return parseMemoryBudget(text)
+    except ValueError as exception:
+        raise argparse.ArgumentTypeError(str(exception))
+
+
+def main(arguments=None):
+    # Headless entry point, python -m bie batch recipe.json in/ out/ edits every image of in/ without Qt windows
+    parser = argparse.ArgumentParser(prog="bie", description="Bensky Image Editor")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser("batch", help="apply a recipe to every image in a directory")
+    batch.add_argument("recipe", help="JSON file with the settings, orientation, crop and presets")
+    batch.add_argument("input", help="directory of images to edit")
+    batch.add_argument("output", help="directory the edited images are written to")
+    batch.add_argument("--max-images", type=int, default=None,
+                       help="most images held in memory at once, one per process (default: number of cores)")
+    batch.add_argument("--restart", action="store_true", help="ignore images finished by an earlier run")
+    batch.add_argument("--memory-budget", type=memoryBudget, default=DEFAULT_MEMORY_BUDGET, metavar="SIZE",
+                       help="RAM shared by the processes for image buffers, past it they are backed by scratch files, "
+                            "e.g. 512M, 4G or none (default: 2G)")
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "batch":
+        # Bad arguments are reported like any other usage error instead of as a traceback
+        if not os.path.isdir(arguments.input):
+            parser.error("input directory {} does not exist".format(arguments.input))
+        if os.path.exists(arguments.output) and not os.path.isdir(arguments.output):
+            parser.error("output {} is not a directory".format(arguments.output))
+        try:
+            recipe = loadRecipe(arguments.recipe)
+        except (OSError, ValueError) as exception:
+            parser.error("invalid recipe {}: {}".format(arguments.recipe, exception))
+        return runBatch(recipe, arguments.input, arguments.output, arguments.max_images, arguments.restart,
+                        arguments.memory_budget)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
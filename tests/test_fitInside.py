@@ -0,0 +1,110 @@
+import math
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageCropTab import CropRectangle
+
+
+def iterativeFit(crop, width, height):
+    # The loop fixCropOverflow ran before fitInside, in floats: the bounding box side that overflows most is moved
+    # back to the edge, the other dimension shrinks by the same ratio about its middle and the corners are mapped
+    # into the smaller box, until no side overflows
+    points = crop.points.copy()
+    for step in range(1000):
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
+        overflows = {"left": -left, "top": -top, "right": right - width, "bottom": bottom - height}
+        side = max(overflows, key=overflows.get)
+        pixel = overflows[side]
+        if pixel <= 1e-9:
+            return points
+        boxWidth, boxHeight = right - left, bottom - top
+        if side in ("left", "right"):
+            shrink = pixel / 2 * boxHeight / boxWidth
+            box = (left + pixel, top + shrink, right, bottom - shrink) if side == "left" else \
+                (left, top + shrink, right - pixel, bottom - shrink)
+        else:
+            shrink = pixel / 2 * boxWidth / boxHeight
+            box = (left + shrink, top + pixel, right - shrink, bottom) if side == "top" else \
+                (left + shrink, top, right - shrink, bottom - pixel)
+        points = (points - (left, top)) / (boxWidth, boxHeight) * (box[2] - box[0], box[3] - box[1]) + box[:2]
+    raise AssertionError("the iterative fit did not converge")
+
+
+def randomCrops(count, seed=17):
+    # Images from tiny to 50 MP, crops from a sliver to larger than the image at any rotation the slider allows,
+    # centered inside the image like every crop the view lets through but partly outside it
+    rng = random.Random(seed)
+    for i in range(count):
+        width, height = rng.uniform(16, 9000), rng.uniform(16, 6000)
+        cropWidth, cropHeight = rng.uniform(2, 1.3 * width), rng.uniform(2, 1.3 * height)
+        crop = CropRectangle(0, 0, cropWidth, cropHeight)
+        crop.rotate(rng.uniform(-45, 45))
+        crop.translate(*(np.array([rng.uniform(0, width), rng.uniform(0, height)]) - crop.center()))
+        yield crop, width, height
+
+
+def size(points):
+    return math.hypot(*(points[1] - points[0])), math.hypot(*(points[2] - points[0]))
+
+
+class FitInsideTest(unittest.TestCase):
+    def assertInside(self, points, width, height):
+        tolerance = 1e-6 * max(width, height)
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
+        self.assertGreaterEqual(left, -tolerance)
+        self.assertGreaterEqual(top, -tolerance)
+        self.assertLessEqual(right, width + tolerance)
+        self.assertLessEqual(bottom, height + tolerance)
+
+    def test_fits_inside_like_the_iterative_loop(self):
+        for crop, width, height in randomCrops(2000):
+            before = crop.points.copy()
+            cropWidth, cropHeight = size(before)
+            reference = iterativeFit(crop, width, height)
+            crop.fitInside(width, height)
+
+            self.assertInside(reference, width, height)
+            self.assertInside(crop.points, width, height)
+            # Both keep the crop's aspect ratio and rotation
+            for points in (reference, crop.points):
+                fittedWidth, fittedHeight = size(points)
+                self.assertAlmostEqual(fittedWidth / fittedHeight, cropWidth / cropHeight,
+                                       delta=1e-9 * cropWidth / cropHeight)
+                np.testing.assert_allclose(points[1] - points[0], (before[1] - before[0]) * fittedWidth / cropWidth,
+                                           atol=1e-6 * max(width, height))
+            # The closed form keeps the largest crop that fits, never a smaller one than the loop did
+            scale = min(1, width / np.ptp(before[:, 0]), height / np.ptp(before[:, 1]))
+            self.assertAlmostEqual(size(crop.points)[0], cropWidth * scale, delta=1e-9 * cropWidth)
+            self.assertGreaterEqual(size(crop.points)[0], size(reference)[0] * (1 - 1e-9))
+
+    def test_crop_inside_is_unchanged(self):
+        rng = random.Random(5)
+        for i in range(500):
+            width, height = rng.uniform(100, 6000), rng.uniform(100, 6000)
+            side = min(width, height) / 2
+            crop = CropRectangle(0, 0, rng.uniform(1, side), rng.uniform(1, side))
+            crop.rotate(rng.uniform(-45, 45))
+            crop.translate(*(np.array([width / 2, height / 2]) - crop.center()))
+            before = crop.points.copy()
+            crop.fitInside(width, height)
+            np.testing.assert_array_equal(crop.points, before)
+            np.testing.assert_allclose(iterativeFit(crop, width, height), before)
+
+    def test_overflow_shifts_before_it_shrinks(self):
+        # A crop that fits once moved is moved, not scaled, the loop shrank it instead
+        crop = CropRectangle(-50, 20, 200, 100)
+        crop.fitInside(400, 300)
+        np.testing.assert_allclose(crop.points, CropRectangle(0, 20, 200, 100).points)
+        self.assertLess(size(iterativeFit(CropRectangle(-50, 20, 200, 100), 400, 300))[0], 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
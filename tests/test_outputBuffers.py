@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AdjustmentPipeline import AdjustmentPipeline
+from ImageSource import ImageSource
+
+
+def pixels(image):
+    # The pixels a QImage shows, read through the QImage instead of the array it wraps
+    rows = np.frombuffer(image.constBits(), np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 3].reshape(image.height(), image.width(), 3).copy()
+
+
+class OutputBuffersTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "image.png")
+        data = np.random.default_rng(3).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+        Image.fromarray(data, "RGB").save(path)
+        self.pipeline = AdjustmentPipeline(ImageSource(path), precision="float32")
+        self.settings = dict(self.pipeline.settings, brightness=20, sharpness=30)
+
+    def allocations(self):
+        return self.pipeline.allocationStats()["imageAllocations"]
+
+    def test_repeated_renders_reuse_their_buffers(self):
+        # Every invalidation renders again at the same settings and shape, the view holds the last frame while the
+        # next one renders so two buffers take turns
+        counts = []
+        image = None
+        for i in range(8):
+            self.pipeline.invalidate()
+            image = self.pipeline.image(settings=self.settings)
+            counts.append(self.allocations())
+        self.assertEqual(counts[2:], [counts[1]] * 6)
+
+        counts = []
+        for i in range(8):
+            image = self.pipeline.regionImage((10, 20, 90, 140), 2, settings=dict(self.settings, brightness=i))
+            counts.append(self.allocations())
+        self.assertEqual(counts[2:], [counts[1]] * 6)
+
+    def test_buffers_in_use_are_not_written_over(self):
+        image = self.pipeline.image(settings=self.settings)
+        shown = pixels(image)
+        data = self.pipeline.render(settings=dict(self.settings, warmth=40))
+        rendered = data.copy()
+        for i in range(6):
+            self.pipeline.invalidate()
+            self.pipeline.image(settings=dict(self.settings, brightness=i))
+        np.testing.assert_array_equal(pixels(image), shown)
+        np.testing.assert_array_equal(data, rendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
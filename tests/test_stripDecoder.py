@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageSource import ImageSource
+from StripDecoder import decodeStrips
+
+
+class StripDecoderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        rows, columns = np.mgrid[0:301, 0:223]
+        noise = np.random.default_rng(7).integers(0, 256, rows.shape)
+        self.image = Image.fromarray(np.stack([(columns * 7 + rows * 3) % 256, (columns ^ rows) % 256, noise],
+                                              -1).astype(np.uint8), "RGB")
+
+    def save(self, name, image, **options):
+        path = os.path.join(self.directory, name)
+        image.save(path, **options)
+        return path
+
+    def test_strips_match_the_whole_decode(self):
+        # Odd strip heights so no strip lines up with a TIFF strip or the end of the image
+        image = self.image
+        paths = [self.save("rgb.png", image), self.save("rgba.png", image.convert("RGBA")),
+                 self.save("gray.png", image.convert("L")), self.save("bits.png", image.convert("1")),
+                 self.save("palette.png", image.convert("P", colors=16), bits=4),
+                 self.save("gray16.png", Image.fromarray(np.asarray(image)[:, :, 0].astype(np.uint16) * 257)),
+                 self.save("rgb.tif", image), self.save("strips.tif", image, tiffinfo={278: 7}),
+                 self.save("palette.tif", image.convert("P")), self.save("rgb.bmp", image),
+                 self.save("rgb.ppm", image)]
+        for path in paths:
+            for rows in (1, 13, 1000):
+                with Image.open(path) as opened:
+                    strips = decodeStrips(opened, rows)
+                    self.assertIsNotNone(strips, path)
+                    data = np.zeros((opened.height, opened.width, 3), np.uint8)
+                    for left, top, strip in strips:
+                        self.assertLessEqual(strip.height, rows)
+                        data[top:top + strip.height, left:left + strip.width] = np.asarray(strip.convert("RGB"))
+                with Image.open(path) as reference:
+                    np.testing.assert_array_equal(data, np.asarray(reference.convert("RGB")), path)
+
+    def test_other_formats_decode_whole(self):
+        for path in (self.save("image.jpg", self.image), self.save("deflate.tif", self.image,
+                                                                    compression="tiff_deflate")):
+            with Image.open(path) as opened:
+                self.assertIsNone(decodeStrips(opened, 13))
+            with Image.open(path) as reference:
+                np.testing.assert_array_equal(ImageSource(path).data, np.asarray(reference.convert("RGB")))
+
+    def test_truncated_png(self):
+        path = self.save("rgb.png", self.image)
+        with open(path, "rb") as file:
+            data = file.read()
+        with open(path, "wb") as file:
+            file.write(data[:len(data) // 2])
+        with self.assertRaises(OSError):
+            ImageSource(path)
+
+
+if __name__ == "__main__":
+    unittest.main()